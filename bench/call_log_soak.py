@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Soak test of the per-call logging: calls are started and ended continuously,
+each logging a few records, while the memory, the registered loggers and the
+open files are reported; they should all stay flat
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import log_writer  # noqa: E402 pylint: disable=wrong-import-position
+import call_logger  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def rss_kb():
+    """ Returns the resident memory of the process, in KB """
+    with open("/proc/self/status", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS"):
+                return int(line.split()[1])
+    return 0
+
+
+def report(calls):
+    """ Prints the resources held after a number of calls """
+    stats = log_writer._writer.get_stats()  # pylint: disable=protected-access
+    print(f"{calls:8d} calls: rss {rss_kb():7d} KB, "
+          f"loggers {len(logging.Logger.manager.loggerDict):3d}, "
+          f"open files {len(call_logger.get_router().files):4d}, "
+          f"fds {len(os.listdir('/proc/self/fd')):4d}, "
+          f"written {stats['written']}, dropped "
+          f"{stats['dropped_full'] + stats['dropped_rate']}")
+
+
+def main():
+    """ Runs the soak test """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--calls", type=int, default=30000,
+                        help="calls started, in total")
+    parser.add_argument("-c", "--concurrent", type=int, default=300,
+                        help="calls in progress at any time")
+    parser.add_argument("-r", "--records", type=int, default=3,
+                        help="records logged by each call")
+    parser.add_argument("-i", "--interval", type=int, default=5000,
+                        help="calls between reports")
+    args = parser.parse_args()
+
+    # the call logs are written under the current directory
+    os.chdir(tempfile.mkdtemp(prefix="call_log_soak."))
+    print(f"writing the call logs in {os.getcwd()}")
+    log_writer.start()
+
+    live = []
+    for i in range(args.calls):
+        log = call_logger.create_call_logger(f"B2B.{i}", f"{i % 10}")
+        logger = log.get_logger()
+        for n in range(args.records):
+            logger.info("Received message: %s", {"type": "x", "n": n})
+        live.append(log)
+        if len(live) > args.concurrent:
+            live.pop(0).cleanup()
+        if i % args.interval == 0:
+            # let the writer catch up, so the files it holds are counted
+            time.sleep(0.5)
+            report(i)
+    for log in live:
+        log.cleanup()
+    time.sleep(0.5)
+    report(args.calls)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Replays a stream of OpenAI realtime server events through the event handler
+of the OpenAI engine, and through the former handling of audio deltas (full
+parse, base64 decoding and framing in a thread); the audio queued by both
+must be identical
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# pylint: disable=wrong-import-position
+from aiortc.sdp import SessionDescription  # noqa: E402
+import openai_api  # noqa: E402
+from openai_api import OpenAI  # noqa: E402
+
+SDP = ("v=0\r\no=- 1 1 IN IP4 127.0.0.1\r\ns=-\r\nc=IN IP4 127.0.0.1\r\n"
+       "t=0 0\r\nm=audio 40000 RTP/AVP 0\r\na=rtpmap:0 PCMU/8000\r\n")
+
+
+def synthesize(responses, deltas, delta_len):
+    """ Returns the events of responses made of audio and transcript deltas,
+    as sent by the server """
+    events = []
+    for r in range(responses):
+        response_id, item_id = f"resp_{r:04d}", f"item_{r:04d}"
+        delta = {"response_id": response_id, "item_id": item_id,
+                 "output_index": 0, "content_index": 0}
+        events.append({"type": "response.created", "event_id": "event_c",
+                       "response": {"id": response_id,
+                                    "object": "realtime.response",
+                                    "status": "in_progress", "output": []}})
+        for d in range(deltas):
+            events.append({"type": "response.audio_transcript.delta",
+                           "event_id": f"event_t{d}", **delta,
+                           "delta": " word"})
+            events.append({"type": "response.audio.delta",
+                           "event_id": f"event_a{d}", **delta,
+                           "delta": base64.b64encode(
+                               os.urandom(delta_len)).decode()})
+        events.append({"type": "response.audio.done", "event_id": "event_d",
+                       **delta})
+        events.append({"type": "response.done", "event_id": "event_e",
+                       "response": {"id": response_id, "status": "completed",
+                                    "output": [{"type": "message"}]}})
+    return [json.dumps(e, separators=(",", ":")) for e in events]
+
+
+class Queue():
+    """ Collects the audio queued for playback """
+
+    def __init__(self):
+        self.packets = []
+
+    def put_nowait(self, payload, item_id=None):
+        """ Keeps a copy of a frame """
+        self.packets.append((bytes(payload), item_id))
+
+    def clear(self):
+        """ Nothing is played, so nothing is dropped """
+        return 0
+
+
+class Call():  # pylint: disable=too-few-public-methods
+    """ The parts of a call used by the engine """
+
+    def __init__(self):
+        self.sdp = SessionDescription.parse(SDP)
+        self.rtp = Queue()
+        self.to = "sip:bot@localhost"
+        self.b2b_key = "B2B.replay"
+        self.transcoder = None
+        self.terminated = False
+
+
+class Replay():  # pylint: disable=too-few-public-methods
+    """ Feeds the recorded events to the engine, as its WebSocket """
+
+    def __init__(self, events):
+        self.events = events
+
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+
+
+async def legacy_handle(engine, ws):
+    """ How the audio deltas were handled before the dispatch table """
+    leftovers = b''
+    async for smsg in ws:
+        msg = json.loads(smsg)
+        t = msg["type"]
+        if t == "response.audio.delta":
+            media = base64.b64decode(msg["delta"])
+            packets, leftovers = await asyncio.to_thread(
+                engine.codec.parse, media, leftovers)
+            for packet in packets:
+                engine.queue.put_nowait(packet, msg["item_id"])
+        elif t == "response.audio.done":
+            if leftovers:
+                packet = await asyncio.to_thread(engine.codec.parse, None,
+                                                 leftovers)
+                engine.queue.put_nowait(packet, msg["item_id"])
+                leftovers = b''
+
+
+async def replay(events, legacy=False):
+    """ Returns the time spent handling the events, and the audio queued """
+    call = Call()
+    engine = OpenAI(call, {})
+    engine.ws = Replay(events)
+    start = time.perf_counter()
+    if legacy:
+        await legacy_handle(engine, engine.ws)
+    else:
+        await engine.handle_command()
+    return time.perf_counter() - start, call.rtp.packets
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-e", "--events",
+                        help="file with the recorded server events, one raw "
+                        "WebSocket message per line; synthesized if missing")
+    parser.add_argument("--record",
+                        help="saves the synthesized events to this file")
+    parser.add_argument("-r", "--responses", type=int, default=20,
+                        help="responses to synthesize")
+    parser.add_argument("-d", "--deltas", type=int, default=50,
+                        help="audio deltas per response")
+    parser.add_argument("-l", "--delta-len", type=int, default=800,
+                        help="bytes of audio per delta (800 is 100ms G.711)")
+    parser.add_argument("-n", "--rounds", type=int, default=5,
+                        help="times the events are replayed, the best one "
+                        "is reported")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    if args.events:
+        with open(args.events, encoding="utf-8") as f:
+            events = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        events = synthesize(args.responses, args.deltas, args.delta_len)
+        if args.record:
+            with open(args.record, "w", encoding="utf-8") as f:
+                f.write("\n".join(events) + "\n")
+
+    backends = [("legacy", True, json.loads),
+                ("json", False, json.loads)]
+    if openai_api.json_loads is not json.loads:
+        backends.append(("orjson", False, openai_api.json_loads))
+    fast_loads = openai_api.json_loads
+    reference = None
+    print(f"{len(events)} events")
+    for name, legacy, loads in backends:
+        openai_api.json_loads = loads
+        best = None
+        for _ in range(args.rounds):
+            spent, packets = asyncio.run(replay(events, legacy))
+            best = spent if best is None else min(best, spent)
+        if reference is None:
+            reference = packets
+        elif packets != reference:
+            sys.exit(f"{name}: the audio queued differs from the legacy one")
+        print(f"{name:8s} {best / len(events) * 1e6:8.1f} us/event, "
+              f"{len(packets)} frames")
+    openai_api.json_loads = fast_loads
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compares the struct based RTP encoding and decoding with the former hex
+string based functions, as they were called by Call.read_rtp/send_rtp
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from rtp import decode_rtp_packet, RtpStream  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def legacy_decode_rtp_packet(packet_bytes):
+    """ The former decoder, working on the hex string of a packet """
+    packet_vars = {}
+    byte1 = packet_bytes[0:2]
+    byte1 = int(byte1, 16)
+    byte1 = format(byte1, 'b')
+    packet_vars['version'] = int(byte1[0:2], 2)
+    packet_vars['padding'] = int(byte1[2:3])
+    packet_vars['extension'] = int(byte1[3:4])
+    packet_vars['csi_count'] = int(byte1[4:8], 2)
+
+    byte2 = packet_bytes[2:4]
+
+    byte2 = int(byte2, 16)
+    byte2 = format(byte2, 'b').zfill(8)
+    packet_vars['marker'] = int(byte2[0:1])
+    packet_vars['payload_type'] = int(byte2[1:8], 2)
+
+    packet_vars['sequence_number'] = int(str(packet_bytes[4:8]), 16)
+
+    packet_vars['timestamp'] = int(str(packet_bytes[8:16]), 16)
+
+    packet_vars['ssrc'] = int(str(packet_bytes[16:24]), 16)
+
+    packet_vars['payload'] = str(packet_bytes[24:])
+    return packet_vars
+
+
+def legacy_generate_rtp_packet(packet_vars):
+    """ The former encoder, building the hex string of a packet """
+    version = str(format(packet_vars['version'], 'b').zfill(2))
+    padding = str(packet_vars['padding'])
+    extension = str(packet_vars['extension'])
+    csi_count = str(format(packet_vars['csi_count'], 'b').zfill(4))
+    byte1_body = int((version + padding + extension + csi_count), 2)
+    byte1 = format(byte1_body, 'x').zfill(2)
+
+    marker = str(packet_vars['marker'])
+    payload_type = str(format(packet_vars['payload_type'], 'b').zfill(7))
+    byte2 = format(int((marker + payload_type), 2), 'x').zfill(2)
+
+    sequence_number = format(packet_vars['sequence_number'], 'x').zfill(4)
+
+    timestamp = format(packet_vars['timestamp'], 'x').zfill(8)
+
+    ssrc = str(format(packet_vars['ssrc'], 'x').zfill(8))
+
+    payload = packet_vars['payload']
+
+    packet = byte1 + byte2 + sequence_number + timestamp + ssrc + payload
+
+    return packet
+
+
+def legacy_read(data):
+    """ What Call.read_rtp did for each received packet """
+    packet = legacy_decode_rtp_packet(data.hex())
+    return bytes.fromhex(packet['payload'])
+
+
+def new_read(data):
+    """ What Call.read_rtp does for each received packet """
+    return decode_rtp_packet(data)['payload']
+
+
+def legacy_send(payload, sequence_number, timestamp):
+    """ What Call.send_rtp did for each sent packet """
+    return bytes.fromhex(legacy_generate_rtp_packet({
+        'version': 2,
+        'padding': 0,
+        'extension': 0,
+        'csi_count': 0,
+        'marker': 0,
+        'payload_type': 0,
+        'sequence_number': sequence_number,
+        'timestamp': timestamp,
+        'ssrc': 0x12345678,
+        'payload': payload.hex()
+    }))
+
+
+def measure(name, func, number):
+    """ Prints the best time per call of func, in microseconds """
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:20s} {best * 1e6:8.2f} us/packet")
+    return best
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="packets per round")
+    parser.add_argument("-s", "--size", type=int, default=160,
+                        help="payload size, in bytes (160 for 20ms G.711)")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size)
+    stream = RtpStream(0, 0x12345678, 1000, 160000)
+    packet = stream.build(payload)
+
+    # both implementations must read the same payload back
+    assert legacy_read(packet) == bytes(new_read(packet))
+    check = RtpStream(0, 0x12345678, 1001, 160000)
+    check.marker = False
+    assert legacy_send(payload, 1001, 160000) == check.build(payload)
+
+    print(f"{args.size} bytes payload, {args.number} packets per round")
+    old = measure("decode (hex)", lambda: legacy_read(packet), args.number)
+    new = measure("decode (struct)", lambda: new_read(packet), args.number)
+    print(f"{'':20s} {old / new:8.1f}x")
+    old = measure("encode (hex)",
+                  lambda: legacy_send(payload, 1001, 160000), args.number)
+    new = measure("encode (RtpStream)", lambda: stream.build(payload),
+                  args.number)
+    print(f"{'':20s} {old / new:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
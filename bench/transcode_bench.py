@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measures the throughput of the G.711 <-> PCM16 transcoder: many streams,
+each with its own Transcoder, are converted chunk by chunk, as calls do
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from transcode import Transcoder, G711_RATE  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def tone(rate, seconds, frequency=440.0):
+    """ Returns a PCM16 tone, with some noise """
+    t = np.arange(int(rate * seconds)) / rate
+    samples = 8000 * np.sin(2 * np.pi * frequency * t) + \
+        np.random.default_rng(0).normal(0, 300, len(t))
+    return samples.astype('<i2').tobytes()
+
+
+def run(codec, rate, streams, seconds, chunk_ms):
+    """ Converts seconds of audio, for each stream, in both directions;
+    returns the CPU time spent in each direction """
+    transcoders = [Transcoder(codec, rate) for _ in range(streams)]
+    # the inbound audio, as received from the call
+    g711 = Transcoder(codec, G711_RATE).encode(tone(G711_RATE, seconds))
+    # the outbound audio, as received from the engine
+    pcm = tone(rate, seconds, 660.0)
+    inbound = G711_RATE * chunk_ms // 1000
+    outbound = rate * 2 * chunk_ms // 1000
+
+    start = time.process_time()
+    for pos in range(0, len(g711), inbound):
+        chunk = g711[pos:pos + inbound]
+        for transcoder in transcoders:
+            transcoder.decode(chunk)
+    decode = time.process_time() - start
+
+    start = time.process_time()
+    for pos in range(0, len(pcm), outbound):
+        chunk = pcm[pos:pos + outbound]
+        for transcoder in transcoders:
+            transcoder.encode(chunk)
+    encode = time.process_time() - start
+    return decode, encode
+
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--streams", type=int, default=200,
+                        help="simultaneous streams")
+    parser.add_argument("-s", "--seconds", type=float, default=5,
+                        help="seconds of audio per stream")
+    parser.add_argument("-c", "--chunk-ms", type=int, default=60,
+                        help="milliseconds of audio per chunk")
+    args = parser.parse_args()
+
+    audio = args.streams * args.seconds
+    chunks = audio * 1000 / args.chunk_ms
+    print(f"{args.streams} streams x {args.seconds}s, "
+          f"{args.chunk_ms}ms chunks")
+    print(f"{'codec':6s} {'rate':>6s} {'decode us':>10s} {'encode us':>10s} "
+          f"{'streams/core':>13s}")
+    for codec in ("mulaw", "alaw"):
+        for rate in (8000, 16000, 24000):
+            decode, encode = run(codec, rate, args.streams, args.seconds,
+                                 args.chunk_ms)
+            # a stream is converted in both directions, in real time
+            print(f"{codec:6s} {rate:6d} {decode / chunks * 1e6:10.1f} "
+                  f"{encode / chunks * 1e6:10.1f} "
+                  f"{audio / (decode + encode):13.0f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
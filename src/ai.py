@@ -29,6 +29,7 @@ class AIEngine(ABC):
     """ Class that implements the AI logic """
 
     codec = None
+    pcm_rate = None
 
     @abstractmethod
     def __init__(self, call, cfg, logger=None):
@@ -50,8 +51,17 @@ class AIEngine(ABC):
     def choose_codec(self, sdp):
         """ Returns the preferred codec from a list """
 
+    async def interrupt(self):
+        """ the caller started talking over the engine's audio, which has
+        already been flushed; cancels the response in progress """
+
     def get_codec(self):
         """ returns the chosen codec """
         return self.codec
 
+    def get_pcm_rate(self):
+        """ returns the rate of the linear PCM16 audio the engine prefers,
+        or None if it uses the call's codec """
+        return self.pcm_rate
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" External API functions that can be called by the AI engines """
+
+import re
+import json
+import time
+import asyncio
+import logging
+from functools import lru_cache
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import aiohttp
+
+import metrics
+
+DEFAULT_TIMEOUT = 10
+MAX_CACHED_RESULTS = 1024
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+_sessions = {}
+_results = OrderedDict()
+_stats = {"calls": 0, "errors": 0, "cache_hits": 0}
+_latency = metrics.LatencyStats()
+metrics.register("api_functions",
+                 lambda: {**_stats, "latency_ms": _latency.to_dict(),
+                          "hosts": len(_sessions),
+                          "cached_results": len(_results)})
+
+
+def compile_string(value):
+    """ Returns a function rendering the {variable} placeholders of a
+    string, or the string itself if it has none """
+    parts = PLACEHOLDER.split(value)
+    if len(parts) == 1:
+        return value
+    literals, names = parts[0::2], parts[1::2]
+
+    def render(variables):
+        out = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            if name in variables:
+                var = variables[name]
+                out.append(json.dumps(var) if isinstance(var, dict)
+                           else str(var))
+            else:
+                out.append("{" + name + "}")
+            out.append(literal)
+        return "".join(out)
+    return render
+
+
+def compile_node(node):
+    """ Returns a function rendering a node of a template """
+    if isinstance(node, str):
+        return compile_string(node)
+    if isinstance(node, dict):
+        items = [(compile_string(k), compile_node(v)) for k, v in node.items()]
+        return lambda variables: {
+            (k(variables) if callable(k) else k):
+            (v(variables) if callable(v) else v) for k, v in items}
+    if isinstance(node, list):
+        items = [compile_node(v) for v in node]
+        return lambda variables: [v(variables) if callable(v) else v
+                                  for v in items]
+    return node
+
+
+@lru_cache(maxsize=256)
+def _compile(template_json):
+    renderer = compile_node(json.loads(template_json))
+    if callable(renderer):
+        return renderer
+    return lambda _: json.loads(template_json)
+
+
+def compile_template(template):
+    """ Returns a function rendering a template with a dict of variables;
+    templates are compiled once and shared by all the calls """
+    return _compile(json.dumps(template))
+
+
+def get_session(url):
+    """ Returns the keep-alive HTTP session shared by the calls to a host """
+    parts = urlsplit(url)
+    host = (parts.scheme, parts.netloc)
+    session = _sessions.get(host)
+    if not session or session.closed:
+        session = aiohttp.ClientSession()
+        _sessions[host] = session
+    return session
+
+
+async def close_sessions():
+    """ Closes all the HTTP sessions """
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
+
+
+class ApiFunction():
+    """ An external API function, as configured in the bot """
+
+    def __init__(self, name, cfg):
+        self.name = name
+        self.url = cfg.get('url')
+        self.headers = {'Content-Type': 'application/json'}
+        if cfg.get('token'):
+            self.headers['Authorization'] = f"Bearer {cfg['token']}"
+        self.render = compile_template(cfg.get('input_schema', {}))
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(cfg.get('timeout', DEFAULT_TIMEOUT)))
+        self.cache_ttl = float(cfg.get('cache_ttl', 0))
+
+    async def call(self, variables):
+        """ Calls the API with the rendered template and returns the
+        result; raises an exception on failure """
+        payload = self.render(variables)
+        key = None
+        if self.cache_ttl > 0:
+            key = (self.url, self.headers.get('Authorization'),
+                   json.dumps(payload, sort_keys=True))
+            cached = _results.get(key)
+            if cached and cached[0] > time.monotonic():
+                _stats["cache_hits"] += 1
+                _results.move_to_end(key)
+                return cached[1]
+        _stats["calls"] += 1
+        start = time.perf_counter()
+        try:
+            async with get_session(self.url).post(
+                    self.url, json=payload, headers=self.headers,
+                    timeout=self.timeout) as response:
+                response.raise_for_status()
+                result = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            _stats["errors"] += 1
+            raise TimeoutError(f"{self.name} timed out after "
+                               f"{self.timeout.total}s") from None
+        except Exception:
+            _stats["errors"] += 1
+            raise
+        _latency.observe((time.perf_counter() - start) * 1000)
+        logging.debug("API function %s returned %s", self.name, result)
+        if key:
+            _results[key] = (time.monotonic() + self.cache_ttl, result)
+            _results.move_to_end(key)
+            while len(_results) > MAX_CACHED_RESULTS:
+                _results.popitem(last=False)
+        return result
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
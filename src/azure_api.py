@@ -26,8 +26,10 @@ Azure Services for STT and TTS
 import azure.cognitiveservices.speech as speechsdk
 import logging
 import asyncio
+import threading
 from ai import AIEngine
-from chatgpt_api import ChatGPT
+from chatgpt_api import ChatGPT, Speculator, CONTEXT_TOKENS, \
+    SPECULATION_DELAY
 from codec import get_codecs, CODECS, UnsupportedCodec
 from config import Config
 
@@ -38,7 +40,7 @@ class AzureAI(AIEngine):
 
     llm = None
 
-    def __init__(self, call, cfg):
+    def __init__(self, call, cfg, logger=None):
         self.queue = call.rtp
         self.call = call
         self.codec = self.choose_codec(call.sdp)
@@ -58,6 +60,9 @@ class AzureAI(AIEngine):
         self.instructions = self.cfg.get("instructions", "AZURE_INSTRUCTIONS")
 
         self.events = asyncio.Queue()
+        # used to serialize the speech events
+        self.speech_lock = asyncio.Lock()
+        self.speech_tasks = set()
 
         speech_config = speechsdk.SpeechConfig(subscription=self.key, region=self.region)
         speech_config.speech_recognition_language=self.language
@@ -83,7 +88,20 @@ class AzureAI(AIEngine):
         else:
             raise UnsupportedCodec(self.codec.name)
         
-        AzureAI.llm.create_call(self.b2b_key, self.instructions)
+        AzureAI.llm.create_call(
+            self.b2b_key, self.instructions,
+            int(self.cfg.get("context_tokens", "AZURE_CONTEXT_TOKENS",
+                             CONTEXT_TOKENS)),
+            self.cfg.getboolean("context_summary", "AZURE_CONTEXT_SUMMARY",
+                                False))
+        self.speculator = None
+        if self.cfg.getboolean("speculative", "AZURE_SPECULATIVE", False):
+            self.speculator = Speculator(
+                AzureAI.llm, self.b2b_key,
+                int(self.cfg.get("speculative_delay_ms",
+                                 "AZURE_SPECULATIVE_DELAY_MS",
+                                 SPECULATION_DELAY)))
+        self.loop = None
 
         self.input_stream = speechsdk.audio.PushAudioInputStream(
                                                                 stream_format=self.audio_format
@@ -93,47 +111,120 @@ class AzureAI(AIEngine):
 
         self.synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
 
+        # the callbacks run in the threads of the SDK
         def recognize_callback(evt):
             if len(evt.result.text) <= 2:
                 return
             
             logging.info("Speaker: %s", evt.result.text)
-            self.events.put_nowait(evt.result.text)
+            self.loop.call_soon_threadsafe(self.events.put_nowait,
+                                           evt.result.text)
 
-        self.speech_recognizer.recognized.connect(recognize_callback)
+        def recognizing_callback(evt):
+            if len(evt.result.text) <= 2:
+                return
+            self.loop.call_soon_threadsafe(self.speculator.hypothesis,
+                                           evt.result.text)
 
-    def speak(self, phrase):
-        """ Speaks a phrase """
-        result = self.synthesizer.speak_text_async(phrase).get()
-        self.drain_queue()
+        self.speech_recognizer.recognized.connect(recognize_callback)
+        if self.speculator:
+            self.speech_recognizer.recognizing.connect(recognizing_callback)
 
+    def speak(self, phrase, loop, play, cancelled):
+        """ Speaks a phrase, passing its frames to play, in loop, as soon as
+        they are synthesized; runs in a thread, until cancelled """
+        result = self.synthesizer.start_speaking_text_async(phrase).get()
         stream = speechsdk.AudioDataStream(result)
-        data = b''
-        buffer = bytes(self.codec.get_payload_len())
-        while True:
+        framer = self.codec.get_framer()
+        buffer = bytes(self.codec.get_payload_len() * 10)
+        while not cancelled.is_set():
             red = stream.read_data(buffer)
             if red == 0:
                 break
-            data += buffer
-        packets, _ = self.codec.parse(data, b'')
-        return packets 
+            # read_data fills the buffer in place, while the frames are
+            # played by the loop: a view is copied by the framer, but
+            # bytes are not, and buffer[:red] is the buffer itself
+            frames = framer.feed(memoryview(buffer)[:red])
+            if frames:
+                loop.call_soon_threadsafe(play, frames)
+        packet = framer.flush()
+        if packet:
+            loop.call_soon_threadsafe(play, [packet])
+
+    def schedule_speech(self, speech):
+        """ Runs the playing of a phrase, or of an answer, in the
+        background """
+        task = asyncio.create_task(speech)
+        self.speech_tasks.add(task)
+        task.add_done_callback(self.speech_tasks.discard)
+
+    def cancel_speech(self):
+        """ Stops generating, synthesizing and playing the phrases in
+        progress """
+        for task in self.speech_tasks:
+            task.cancel()
+
+    async def interrupt(self):
+        """ Stops synthesizing the phrases in progress """
+        self.cancel_speech()
+        self.drain_queue()
 
     def drain_queue(self):
         """ Drains the playback queue """
-        logging.info("Dropping %d packets", self.queue.qsize())
-        with self.queue.mutex:
-            self.queue.queue.clear()
+        logging.info("Dropping %d packets", self.queue.clear())
+
+    async def process_speech(self, text):
+        """ Plays a text, or the sentences of an answer while it is
+        generated; each sentence is played while it is synthesized """
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        first = True
+
+        def play(frames):
+            nonlocal first
+            if cancelled.is_set():
+                return
+            if first:
+                # a new answer replaces what is still being played
+                first = False
+                self.drain_queue()
+            for frame in frames:
+                self.queue.put_nowait(frame)
 
-    async def process_speech(self, phrase):
-        """ Processes the speech received from LLM """
-        packets = await asyncio.to_thread(self.speak, phrase)
-        for packet in packets:
-            self.queue.put_nowait(packet)
+        try:
+            async with self.speech_lock:
+                if isinstance(text, str):
+                    await asyncio.to_thread(self.speak, text, loop,
+                                            play, cancelled)
+                else:
+                    async for sentence in text:
+                        await asyncio.to_thread(self.speak, sentence, loop,
+                                                play, cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()
+            self.synthesizer.stop_speaking_async()
+            raise
+        finally:
+            if not isinstance(text, str):
+                await text.aclose()
 
-    async def handle_phrase(self, phrase):
-        """ Handles the response from a phrase """
-        response = await AzureAI.llm.handle(self.b2b_key, phrase)
-        asyncio.create_task(self.process_speech(response))
+    def handle_phrase(self, phrase):
+        """ Speaks the answer to a phrase, while it is generated; the
+        previous answer, if still in progress, is replaced """
+        previous = list(self.speech_tasks)
+        self.cancel_speech()
+        self.schedule_speech(self.answer(phrase, previous))
+
+    async def answer(self, phrase, previous):
+        """ Speaks the answer to a phrase, once the previous answers are
+        stopped, so that what they said is in the context first """
+        if previous:
+            await asyncio.wait(previous)
+        if self.speculator:
+            await self.process_speech(self.speculator.answer(phrase))
+        else:
+            await self.process_speech(AzureAI.llm.stream(self.b2b_key,
+                                                         phrase))
 
     def choose_codec(self, sdp):
         """ Returns the preferred codec from a list """
@@ -150,15 +241,16 @@ class AzureAI(AIEngine):
 
     async def start(self):
         """ Starts the Azure AI engine """
+        self.loop = asyncio.get_running_loop()
         self.speech_recognizer.start_continuous_recognition_async()
 
         if self.intro:
-            asyncio.create_task(self.process_speech(self.intro))
+            self.schedule_speech(self.process_speech(self.intro))
 
         try:
             while True:
                 phrase = await self.events.get()
-                await self.handle_phrase(phrase)
+                self.handle_phrase(phrase)
         except asyncio.CancelledError:
             pass
 
@@ -168,5 +260,13 @@ class AzureAI(AIEngine):
 
     async def close(self):
         """ Closes the Azure AI engine """
+        if self.speculator:
+            self.speculator.cancel()
+        # stop the ChatGPT streams and the synthesis of the call
+        tasks = list(self.speech_tasks)
+        self.cancel_speech()
+        if tasks:
+            await asyncio.wait(tasks)
+        AzureAI.llm.delete_call(self.b2b_key)
         self.speech_recognizer.stop_continuous_recognition()
         self.input_stream.close()
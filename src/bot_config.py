@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Fetches the configuration of the bots from the API """
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import aiohttp
+
+import metrics
+
+# how often the cache is saved on disk, at most
+SNAPSHOT_INTERVAL = 10
+
+
+class CacheEntry():  # pylint: disable=too-few-public-methods
+    """ A cached configuration; data is None for unknown bots """
+
+    def __init__(self, data, ttl, fetched=None):
+        self.data = data
+        self.ttl = ttl
+        self.fetched = time.monotonic() if fetched is None else fetched
+
+    def age(self):
+        """ Returns how many seconds ago the entry was fetched """
+        return time.monotonic() - self.fetched
+
+
+class BotConfigClient():  # pylint: disable=too-many-instance-attributes
+    """ Asynchronous, cached client of the bot configuration API
+
+    Configurations are cached per (bot, domain) for a while; once expired,
+    they are still served for up to stale_ttl seconds while being refreshed
+    in the background. Bots the API does not know about are cached as well,
+    for a shorter time. Concurrent lookups of the same bot share a single
+    request. When a snapshot file is configured, the cache is saved there
+    and loaded on startup, so a restart does not hit the API for every bot.
+    At most max_entries bots are cached; the least recently used ones are
+    evicted, so that lookups of unknown bots cannot grow the cache forever.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, api_url, api_key=None, ttl=60, stale_ttl=3600,
+                 negative_ttl=30, timeout=10, snapshot=None,
+                 max_entries=10000):
+        self.api_url = api_url
+        self.headers = {}
+        if api_key:
+            self.headers['Authorization'] = f'Token {api_key}'
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.snapshot = snapshot
+        self.snapshot_task = None
+        self.dirty = False
+        self.session = None
+        self.max_entries = max(1, max_entries)
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0,
+                      "coalesced": 0, "errors": 0, "evicted": 0}
+        self.load_snapshot()
+        metrics.register("bot_config", self.get_stats)
+
+    def get_session(self):
+        """ Returns the pooled HTTP session, creating it on first use """
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers, timeout=self.timeout)
+        return self.session
+
+    async def get(self, bot, domain=None):
+        """ Returns the configuration of a bot, or None if not available """
+        key = (bot, domain)
+        entry = self.cache.get(key)
+        if entry:
+            self.cache.move_to_end(key)
+            age = entry.age()
+            if age < entry.ttl:
+                self.stats["hits"] += 1
+                return entry.data
+            if entry.data is not None and age < entry.ttl + self.stale_ttl:
+                self.stats["stale_hits"] += 1
+                self.refresh(key)
+                return entry.data
+        self.stats["misses"] += 1
+        return await asyncio.shield(self.refresh(key))
+
+    def refresh(self, key):
+        """ Starts fetching a bot, unless it is already being fetched """
+        task = self.inflight.get(key)
+        if task:
+            self.stats["coalesced"] += 1
+            return task
+        task = asyncio.create_task(self.fetch(key))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return task
+
+    async def fetch(self, key):
+        """ Fetches a bot from the API and caches the result """
+        bot, domain = key
+        params = {"bot": bot}
+        if domain:
+            params['domain'] = domain
+        start = time.perf_counter()
+        try:
+            async with self.get_session().get(self.api_url,
+                                              params=params) as response:
+                if response.status == 404:
+                    logging.info("bot %s@%s not found", bot, domain)
+                    self.store(key, CacheEntry(None, self.negative_ttl))
+                    return None
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.stats["errors"] += 1
+            logging.error("Error fetching bot %s@%s: %s", bot, domain, e)
+            entry = self.cache.get(key)
+            if entry and entry.data is not None and \
+                    entry.age() < entry.ttl + self.stale_ttl:
+                return entry.data
+            return None
+        logging.info("fetched bot %s@%s in %.1fms", bot, domain,
+                     (time.perf_counter() - start) * 1000)
+        self.store(key, CacheEntry(data, self.ttl))
+        self.save_snapshot()
+        return data
+
+    def store(self, key, entry):
+        """ Caches an entry, evicting the least recently used ones """
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def load_snapshot(self):
+        """ Loads the cache saved on disk, as already expired entries """
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return
+        try:
+            with open(self.snapshot, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Cannot load bot snapshot %s: %s",
+                            self.snapshot, e)
+            return
+        now = time.monotonic()
+        for entry in entries:
+            age = time.time() - entry["time"]
+            if age >= self.ttl + self.stale_ttl:
+                continue
+            # never trust a snapshot as fresh: refresh on first use
+            self.store((entry["bot"], entry["domain"]), CacheEntry(
+                entry["data"], self.ttl, now - max(age, self.ttl)))
+        logging.info("loaded %d bots from %s", len(self.cache), self.snapshot)
+
+    def save_snapshot(self):
+        """ Schedules saving the cache on disk, at most once in a while """
+        if not self.snapshot:
+            return
+        self.dirty = True
+        if self.snapshot_task:
+            return
+        self.snapshot_task = asyncio.create_task(self.write_snapshot())
+
+    async def write_snapshot(self):
+        """ Writes the cache on disk, without blocking the loop """
+        try:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            self.dirty = False
+            await asyncio.to_thread(self.dump, self.snapshot_entries())
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.warning("Cannot save bot snapshot %s: %s",
+                            self.snapshot, e)
+        finally:
+            self.snapshot_task = None
+
+    def snapshot_entries(self):
+        """ Returns the known bots, as saved in the snapshot """
+        now = time.time()
+        return [{"bot": bot, "domain": domain, "data": entry.data,
+                 "time": now - entry.age()}
+                for (bot, domain), entry in self.cache.items()
+                if entry.data is not None]
+
+    def dump(self, entries):
+        """ Atomically replaces the snapshot file """
+        # workers share the snapshot, but not the temporary file
+        tmp = f"{self.snapshot}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.snapshot)
+
+    def get_stats(self):
+        """ Returns the cache statistics """
+        return {**self.stats, "entries": len(self.cache),
+                "inflight": len(self.inflight)}
+
+    async def close(self):
+        """ Saves the pending snapshot and closes the HTTP session """
+        if self.dirty:
+            self.dirty = False
+            try:
+                self.dump(self.snapshot_entries())
+            except OSError as e:
+                logging.warning("Cannot save bot snapshot %s: %s",
+                                self.snapshot, e)
+        if self.session:
+            await self.session.close()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -20,29 +20,171 @@
 
 """ Handles the a SIP call """
 
+import time
 import random
 import socket
 import asyncio
 import logging
-import secrets
-import datetime
-from queue import Queue, Empty
 from aiortc.sdp import SessionDescription
 from config import Config
-
-from rtp import decode_rtp_packet, generate_rtp_packet
+import metrics
+from ports import PortAllocator, NoAvailablePorts
+from forwarder import AudioForwarder
+from transcode import Transcoder
+from vad import get_vad, get_barge_in
+from playback import PlaybackBuffer
+
+from rtp import decode_rtp_packet, RtpStream, RtpPacketError
 from utils import get_ai
 from call_logger import create_call_logger
 
 rtp_cfg = Config.get("rtp")
 min_rtp_port = int(rtp_cfg.get("min_port", "RTP_MIN_PORT", "35000"))
 max_rtp_port = int(rtp_cfg.get("max_port", "RTP_MAX_PORT", "65000"))
+rtp_port_quarantine = float(rtp_cfg.get("port_quarantine",
+                                        "RTP_PORT_QUARANTINE", "10"))
+
+available_ports = PortAllocator(min_rtp_port, max_rtp_port,
+                                rtp_port_quarantine)
+metrics.register("rtp_ports", available_ports.stats)
+rtp_chunk_ms = int(rtp_cfg.get("chunk_ms", "RTP_CHUNK_MS", "60"))
+rtp_max_buffer_ms = int(rtp_cfg.get("max_buffer_ms", "RTP_MAX_BUFFER_MS",
+                                    "1000"))
+
+BIND_ATTEMPTS = 10
+
+
+def get_local_ip():
+    """ Returns the address of the local hostname """
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except socket.gaierror:  # unknown hostname
+        return "127.0.0.1"
 
-available_ports = set(range(min_rtp_port, max_rtp_port))
 
+rtp_bind_ip = rtp_cfg.get('bind_ip', 'RTP_BIND_IP', '0.0.0.0')
+# resolved once, not for every call
+rtp_ip = rtp_cfg.get('ip', 'RTP_IP') or get_local_ip()
 
-class NoAvailablePorts(Exception):
-    """ There are no available ports """
+setup_latency = {}
+metrics.register("call_setup",
+                 lambda: {stage: stats.to_dict()
+                          for stage, stats in setup_latency.items()})
+
+
+def observe_setup(stage, since):
+    """ Records the duration of a call setup stage, in ms, and returns the
+    time it ended """
+    now = time.perf_counter()
+    stats = setup_latency.get(stage)
+    if not stats:
+        stats = setup_latency[stage] = metrics.LatencyStats()
+    stats.observe((now - since) * 1000)
+    return now
+
+
+def bind_media_socket(logger=logging):
+    """ Returns a non-blocking UDP socket bound to a free RTP port """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in range(BIND_ATTEMPTS):
+        port = available_ports.allocate()
+        try:
+            sock.bind((rtp_bind_ip, port))
+        except OSError as e:
+            # port used by someone else - keep it away for a while
+            logger.warning("Cannot bind to %s:%d: %s", rtp_bind_ip, port, e)
+            available_ports.release(port)
+            continue
+        sock.setblocking(False)
+        return sock
+    sock.close()
+    raise NoAvailablePorts()
+
+
+def release_media_socket(sock):
+    """ Closes a media socket and returns its port to the pool """
+    port = sock.getsockname()[1]
+    sock.close()
+    available_ports.release(port)
+
+
+class MediaClock():
+    """ Paces the outbound RTP of all the calls from a single timer """
+
+    # if the loop falls behind with more than this many ticks, the lost
+    # ticks are skipped instead of bursting packets to catch up
+    MAX_CATCHUP_TICKS = 5
+
+    def __init__(self, ptime):
+        self.ptime = ptime
+        self.ptime_ns = ptime * 1000000
+        self.calls = {}
+        self.task = None
+        self.ticks = 0
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+        self.lateness = metrics.LatencyStats()
+        self.tick_duration = metrics.LatencyStats()
+
+    def add(self, call):
+        """ Starts pacing a call """
+        self.calls[call] = None
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def remove(self, call):
+        """ Stops pacing a call """
+        self.calls.pop(call, None)
+
+    async def run(self):
+        """ Sends a frame for every active call on each tick """
+        next_tick = time.monotonic_ns()
+        while self.calls:
+            now = time.monotonic_ns()
+            late = now - next_tick
+            if late > self.MAX_CATCHUP_TICKS * self.ptime_ns:
+                skipped = late // self.ptime_ns
+                self.skipped_ticks += skipped
+                next_tick += skipped * self.ptime_ns
+                late -= skipped * self.ptime_ns
+            self.ticks += 1
+            self.lateness.observe(late / 1000000)
+            if late > self.ptime_ns // 2:
+                self.late_ticks += 1
+
+            for call in list(self.calls):
+                try:
+                    call.send_frame()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    call.logger.exception("error sending RTP")
+            self.tick_duration.observe((time.monotonic_ns() - now) / 1000000)
+
+            next_tick += self.ptime_ns
+            delay = next_tick - time.monotonic_ns()
+            if delay > 0:
+                await asyncio.sleep(delay / 1000000000)
+
+    def stats(self):
+        """ Returns the pacing statistics """
+        return {"calls": len(self.calls),
+                "ticks": self.ticks,
+                "late_ticks": self.late_ticks,
+                "skipped_ticks": self.skipped_ticks,
+                "lateness_ms": self.lateness.to_dict(),
+                "tick_duration_ms": self.tick_duration.to_dict()}
+
+
+media_clocks = {}
+
+
+def get_media_clock(ptime):
+    """ Returns the media clock that paces calls using ptime """
+    clock = media_clocks.get(ptime)
+    if not clock:
+        clock = MediaClock(ptime)
+        media_clocks[ptime] = clock
+        metrics.register(f"media_clock_{ptime}ms", clock.stats)
+    return clock
 
 
 class Call():  # pylint: disable=too-many-instance-attributes
@@ -50,22 +192,17 @@ class Call():  # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-arguments, too-many-positional-arguments
     def __init__(self,
                  b2b_key,
-                 mi_conn,
+                 mi,
                  sdp: SessionDescription,
                  flavor: str,
                  to: str,
                  user: str,
                  cfg,
-                 bot_id=None):
-        host_ip = rtp_cfg.get('bind_ip', 'RTP_BIND_IP', '0.0.0.0')
-        try:
-            hostname = socket.gethostbyname(socket.gethostname())
-        except socket.gaierror:  # unknown hostname
-            hostname = "127.0.0.1"
-        rtp_ip = rtp_cfg.get('ip', 'RTP_IP', hostname)
-
+                 bot_id=None,
+                 sock=None,
+                 setup_start=None):
         self.b2b_key = b2b_key
-        self.mi_conn = mi_conn
+        self.mi = mi
 
         if sdp.media[0].host:
             self.client_addr = sdp.media[0].host
@@ -75,9 +212,11 @@ class Call():  # pylint: disable=too-many-instance-attributes
         self.paused = False
         self.terminated = False
 
-        self.rtp = Queue()
-        self.stop_event = asyncio.Event()
-        self.stop_event.clear()
+        # the engine picks the codec, thus the ptime is updated later
+        self.rtp = PlaybackBuffer()
+        self.rtp_stream = None
+        self.media_clock = None
+        self.setup_start = setup_start
 
         self.to = to
         self.user = user
@@ -104,29 +243,36 @@ class Call():  # pylint: disable=too-many-instance-attributes
         self.ai = get_ai(flavor, self, cfg)
 
         self.codec = self.ai.get_codec()
+        self.rtp.ptime = self.codec.ptime
+        pcm_rate = self.ai.get_pcm_rate()
+        if pcm_rate and Transcoder.supports(self.codec.name):
+            self.transcoder = Transcoder(self.codec.name, pcm_rate)
+        else:
+            self.transcoder = None
+        if self.codec.concatenable:
+            frames_per_chunk = rtp_chunk_ms // self.codec.ptime
+        else:
+            frames_per_chunk = 1
+        self.forwarder = AudioForwarder(self.ai, frames_per_chunk,
+                                        rtp_max_buffer_ms // self.codec.ptime,
+                                        self.logger, self.transcoder)
+        self.vad = get_vad(flavor, self.ai.cfg, self.codec)
+        self.barge_in = get_barge_in(flavor, self.ai.cfg, self.codec)
 
-        self.serversock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.bind(host_ip)
-        self.serversock.setblocking(False)
+        self.serversock = sock or bind_media_socket(self.logger)
+        self.logger.info("Bound to %s:%d",
+                         *self.serversock.getsockname()[:2])
 
         self.sdp = self.get_new_sdp(sdp, rtp_ip)
 
-        asyncio.create_task(self.ai.start())
+        # the engine connects while the call is being answered
+        self.ai_task = asyncio.create_task(self.ai.start())
 
         self.first_packet = True
         loop = asyncio.get_running_loop()
         loop.add_reader(self.serversock.fileno(), self.read_rtp)
         self.logger.info("handling %s using %s AI", b2b_key, flavor)
 
-    def bind(self, host_ip):
-        """ Binds the call to a port """
-        if not available_ports:
-            raise NoAvailablePorts()
-        port = secrets.choice(list(available_ports))
-        available_ports.remove(port)
-        self.serversock.bind((host_ip, port))
-        self.logger.info("Bound to %s:%d", host_ip, port)
-
     def get_body(self):
         """ Retrieves the SDP built """
         return str(self.sdp)
@@ -175,7 +321,7 @@ class Call():  # pylint: disable=too-many-instance-attributes
                 self.first_packet = False
                 self.client_addr = adr[0]
                 self.client_port = adr[1]
-                asyncio.create_task(self.send_rtp())
+                self.start_rtp()
 
             if adr[0] != self.client_addr or adr[1] != self.client_port:
                 return
@@ -187,80 +333,89 @@ class Call():  # pylint: disable=too-many-instance-attributes
         if self.paused:
             return
         try:
-            packet = decode_rtp_packet(data.hex())
-            audio = bytes.fromhex(packet['payload'])
-            asyncio.create_task(self.ai.send(audio))
-        except ValueError:
-            pass
-
-    async def send_rtp(self):
-        """ Sends all RTP packet """
-
-        sequence_number = random.randint(0, 10000)
-        timestamp = random.randint(0, 10000)
-        ssrc = random.randint(0, 2**31)
-        ts_inc = self.codec.ts_increment
-        ptime = self.codec.ptime
-        payload_type = self.codec.payload_type
-        marker = 1
-        packet_no = 0
-        start_time = datetime.datetime.now()
-
-        while not self.stop_event.is_set():
-            try:
-                payload = self.rtp.get_nowait()
-            except Empty:
-                if self.terminated:
-                    self.terminate()
-                    return
-                if not self.paused:
-                    payload = self.codec.get_silence()
-                else:
-                    payload = None
-            if payload:
-                rtp_packet = generate_rtp_packet({
-                    'version': 2,
-                    'padding': 0,
-                    'extension': 0,
-                    'csi_count': 0,
-                    'marker': marker,
-                    'payload_type': payload_type,
-                    'sequence_number': sequence_number,
-                    'timestamp': timestamp,
-                    'ssrc': ssrc,
-                    'payload': payload.hex()
-                })
-                marker = 0
-                sequence_number += 1
-                self.serversock.sendto(bytes.fromhex(rtp_packet),
-                                       (self.client_addr, self.client_port))
-
-            timestamp += ts_inc
-            packet_no += 1
-            next_time = start_time + datetime.timedelta(milliseconds=ptime *
-                                                        packet_no)
-            now = datetime.datetime.now()
-            drift = (next_time - now).total_seconds()
-            if drift > 0:
-                await asyncio.sleep(float(drift))
+            packet = decode_rtp_packet(data)
+        except RtpPacketError:
+            return
+        payload = bytes(packet['payload'])
+        if self.barge_in and \
+                self.barge_in.process(payload, not self.rtp.empty()):
+            self.interrupt()
+        if not self.vad:
+            self.forwarder.put(payload)
+            return
+        active = self.vad.active
+        for frame in self.vad.process(payload):
+            self.forwarder.put(frame)
+        if active and not self.vad.active:
+            # end of utterance - do not hold its tail
+            self.forwarder.flush()
+
+    def start_rtp(self):
+        """ Starts sending RTP packets """
+        self.rtp_stream = RtpStream(self.codec.payload_type,
+                                    ssrc=random.randint(0, 2**31),
+                                    sequence_number=random.randint(0, 10000),
+                                    timestamp=random.randint(0, 10000))
+        self.media_clock = get_media_clock(self.codec.ptime)
+        self.media_clock.add(self)
+
+    def send_frame(self):
+        """ Sends the RTP packet of the current tick """
+        payload = self.rtp.pop()
+        if payload:
+            if self.barge_in:
+                self.barge_in.played(payload)
+            if self.setup_start:
+                observe_setup("first_audio", self.setup_start)
+                self.setup_start = None
+        else:
+            if self.terminated:
+                self.terminate()
+                return
+            if self.barge_in:
+                self.barge_in.idle()
+            if not self.paused:
+                payload = self.codec.get_silence()
+            else:
+                payload = None
+        if payload:
+            self.serversock.sendto(self.rtp_stream.build(payload),
+                                   (self.client_addr, self.client_port))
+        self.rtp_stream.skip(self.codec.ts_increment)
+
+    def flush_playback(self):
+        """ Drops the audio queued to be played """
+        return self.rtp.clear()
+
+    def interrupt(self):
+        """ Stops the playback when the caller talks over the engine """
+        count = self.flush_playback()
+        self.logger.info("barge-in: dropping %d packets", count)
+        asyncio.create_task(self.ai.interrupt())
 
     async def close(self):
         """ Closes the call """
         self.logger.info("Call %s closing", self.b2b_key)
         loop = asyncio.get_running_loop()
         loop.remove_reader(self.serversock.fileno())
-        free_port = self.serversock.getsockname()[1]
-        self.serversock.close()
-        available_ports.add(free_port)
-        self.stop_event.set()
-        await self.ai.close()
-        # Cleanup call logger
-        self.call_logger.cleanup()
+        release_media_socket(self.serversock)
+        self.forwarder.close()
+        if self.media_clock:
+            self.media_clock.remove(self)
+        # the call may be closed before the engine is even connected
+        self.ai_task.cancel()
+        try:
+            await self.ai.close()
+        finally:
+            # Cleanup call logger
+            self.call_logger.cleanup()
 
     def terminate(self):
         """ Terminates the call """
         self.logger.info("Terminating call %s", self.b2b_key)
-        self.mi_conn.execute("ua_session_terminate", {"key": self.b2b_key})
+        if self.media_clock:
+            self.media_clock.remove(self)
+        self.mi.send("ua_session_terminate", {"key": self.b2b_key})
         asyncio.create_task(self.close())
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -6,82 +6,124 @@ Call-specific logging utilities
 import os
 import logging
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+
+import log_writer
+from log_writer import CallFileHandler
+from config import Config
+
+
+# a single logger is shared by all the calls; records carry their file
+_call_logger = logging.getLogger("call")
+_call_logger.setLevel(logging.INFO)
+_call_logger.propagate = False
+_router = None  # pylint: disable=invalid-name
+
+
+class CallLogRouter(logging.Handler):
+    """Writes the records of each call to its own file, keeping open only
+    the files of the calls that logged most recently"""
+
+    def __init__(self, max_files=256):
+        super().__init__()
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.setFormatter(logging.Formatter(
+            '%(asctime)s - tid: %(thread)d - %(levelname)s - %(message)s'
+        ))
+
+    def get_file(self, path):
+        """Returns the handler of a call's file"""
+        handler = self.files.get(path)
+        if handler:
+            self.files.move_to_end(path)
+            return handler
+        # a closed file is reopened in append mode when written
+        handler = CallFileHandler(path)
+        handler.setFormatter(self.formatter)
+        self.files[path] = handler
+        if len(self.files) > self.max_files:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        return handler
+
+    def emit(self, record):
+        path = getattr(record, "call_log_file", None)
+        if path:
+            self.get_file(path).handle(record)
+
+    def sync(self):
+        """Flushes the files written since the last sync"""
+        for handler in self.files.values():
+            handler.sync()
+
+    def close_file(self, path):
+        """Closes the file of a call that ended"""
+        handler = self.files.pop(path, None)
+        if handler:
+            handler.close()
+
+
+def get_router():
+    """Returns the handler routing the records of the calls to their files"""
+    global _router  # pylint: disable=global-statement
+    if not _router:
+        _router = CallLogRouter(int(Config.engine(
+            "call_log_max_files", "CALL_LOG_MAX_FILES", "256")))
+        _call_logger.addHandler(log_writer.get_handler(_router))
+    return _router
 
 
 class CallLogger:
     """Manages call-specific logging"""
-    
+
     def __init__(self, call_id, bot_id=None):
         """
         Initialize call logger
-        
+
         :param call_id: Unique call identifier (e.g., B2B.502.79.1756047989.2127904424)
         :param bot_id: Bot identifier (optional)
         """
         self.call_id = call_id
         self.bot_id = bot_id or "unknown"
         self.logger = None
+        self.router = None
         self.log_file_path = None
-        
+
     def setup(self):
         """Setup call-specific logger"""
-        # Create directory structure
+        # The directory is created by the log writer, off the event loop
         today = datetime.now().strftime("%Y-%m-%d")
         log_dir = os.path.join("logs", today, f"bot_{self.bot_id}")
-        os.makedirs(log_dir, exist_ok=True)
-        
+
         # Create log file path
         self.log_file_path = os.path.join(log_dir, f"call_{self.call_id}.log")
-        
-        # Create logger with unique name to prevent propagation to root logger
-        logger_name = f"call_{self.call_id}"
-        self.logger = logging.getLogger(logger_name)
-        self.logger.setLevel(logging.INFO)
-        
-        # Prevent propagation to root logger
-        self.logger.propagate = False
-        
-        # Prevent duplicate handlers
-        if self.logger.handlers:
-            return self.logger
-            
-        # Create file handler
-        file_handler = RotatingFileHandler(
-            self.log_file_path,
-            maxBytes=10*1024*1024,  # 10MB
-            backupCount=3,
-            encoding='utf-8'
-        )
-        
-        # Create formatter
-        formatter = logging.Formatter(
-            '%(asctime)s - tid: %(thread)d - %(levelname)s - %(message)s'
-        )
-        file_handler.setFormatter(formatter)
-        
-        # Add handler to logger
-        self.logger.addHandler(file_handler)
-        
+
+        # The adapter only tags the records with the call's file, so no
+        # logger is registered (and kept forever) for each call
+        self.router = get_router()
+        self.logger = logging.LoggerAdapter(
+            _call_logger, {"call_log_file": self.log_file_path})
+
         # Log call start
-        self.logger.info(f"Call started - ID: {self.call_id}, Bot: {self.bot_id}")
-        
+        self.logger.info("Call started - ID: %s, Bot: %s", self.call_id, self.bot_id)
+
         return self.logger
-    
+
     def get_logger(self):
         """Get the call logger"""
         if not self.logger:
             self.setup()
         return self.logger
-    
+
     def cleanup(self):
-        """Cleanup logger handlers"""
+        """Logs the end of the call and closes its file"""
         if self.logger:
-            for handler in self.logger.handlers[:]:
-                handler.close()
-                self.logger.removeHandler(handler)
-            self.logger.info(f"Call ended - ID: {self.call_id}")
-    
+            self.logger.info("Call ended - ID: %s", self.call_id)
+            path = self.log_file_path
+            router = self.router
+            log_writer.call(lambda: router.close_file(path))
+
     def get_log_file_path(self):
         """Get the log file path"""
         return self.log_file_path
@@ -90,7 +132,7 @@ class CallLogger:
 def create_call_logger(call_id, bot_id=None):
     """
     Factory function to create call logger
-    
+
     :param call_id: Unique call identifier
     :param bot_id: Bot identifier (optional)
     :return: CallLogger instance
@@ -21,9 +21,149 @@
 
 """ Communicates with ChatGPT AI """
 
+import re
+import time
+import asyncio
 import logging
+from collections import deque
 from openai import AsyncOpenAI  # pylint: disable=import-error
 
+import metrics
+from segmenter import SentenceSegmenter
+
+# ms an interim transcript has to stay unchanged to be answered, unless
+# configured
+SPECULATION_DELAY = 300
+
+NON_WORDS = re.compile(r"[^\w']+")
+
+# prompt size of a call, in estimated tokens, unless configured
+CONTEXT_TOKENS = 4000
+# tokens added by the API to each message
+MESSAGE_TOKENS = 4
+# length of the summary of the messages that no longer fit in the context
+SUMMARY_TOKENS = 200
+SUMMARY_PROMPT = ("Summarize the following conversation between a caller "
+                  "and a voice assistant in a few sentences, keeping the "
+                  "names, numbers and decisions that may be needed later.")
+
+_context_stats = {"trimmed": 0, "summaries": 0, "summary_errors": 0}
+_prompt_estimated = metrics.LatencyStats()
+_prompt_tokens = metrics.LatencyStats()
+metrics.register("chatgpt_context",
+                 lambda: {**_context_stats,
+                          "prompt_tokens_estimated":
+                              _prompt_estimated.to_dict(),
+                          "prompt_tokens": _prompt_tokens.to_dict()})
+
+_speculation_stats = {"started": 0, "hits": 0, "misses": 0, "restarts": 0,
+                      "wasted_chars": 0}
+# how much earlier the answers used were requested
+_speculation_lead = metrics.LatencyStats()
+metrics.register("speculation",
+                 lambda: {**_speculation_stats,
+                          "lead_ms": _speculation_lead.to_dict()})
+
+
+def estimate_tokens(message):
+    """ Returns a cheap estimate of the tokens of a message """
+    return len(message["content"]) // 4 + MESSAGE_TOKENS
+
+
+class Conversation:
+    """ The context of a call, bounded to a budget of tokens
+
+    The system prompt is always kept; the oldest messages are dropped when
+    the estimated size of the context exceeds the budget. If enabled, the
+    dropped messages are summarized in the background, and the summary is
+    sent after the system prompt.
+    """
+
+    def __init__(self, chatgpt, hint, max_tokens=CONTEXT_TOKENS,
+                 summarize=False):
+        self.chatgpt = chatgpt
+        self.system = {"role": "system", "content": hint}
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary = None
+        self.window = deque()
+        self.tokens = estimate_tokens(self.system)
+        self.dropped = []
+        self.task = None
+        # changes whenever a message is added
+        self.version = 0
+
+    def append(self, message):
+        """ Adds a message, dropping the oldest ones if needed """
+        self.window.append(message)
+        self.tokens += estimate_tokens(message)
+        self.version += 1
+        self.trim()
+
+    def trim(self):
+        """ Drops the oldest messages, but the last one, over the budget """
+        while self.tokens > self.max_tokens and len(self.window) > 1:
+            message = self.window.popleft()
+            self.tokens -= estimate_tokens(message)
+            _context_stats["trimmed"] += 1
+            if self.summarize:
+                self.dropped.append(message)
+        if self.dropped and not self.task:
+            self.task = asyncio.create_task(self.update_summary())
+
+    def prompt(self, message=None):
+        """ Returns the messages to be sent, with an extra one, if any """
+        messages = [self.system]
+        if self.summary:
+            messages.append(self.summary)
+        messages.extend(self.window)
+        tokens = self.tokens
+        if message:
+            messages.append(message)
+            tokens += estimate_tokens(message)
+        _prompt_estimated.observe(tokens)
+        logging.info("Prompt: %d messages, ~%d tokens", len(messages), tokens)
+        return messages
+
+    async def update_summary(self):
+        """ Adds the dropped messages to the summary, off the turns """
+        try:
+            while self.dropped:
+                dropped, self.dropped = self.dropped, []
+                text = "\n".join(f"{m['role']}: {m['content']}"
+                                 for m in dropped)
+                if self.summary:
+                    text = f"{self.summary['content']}\n{text}"
+                response = await self.chatgpt.api.chat.completions.create(
+                    model=self.chatgpt.model,
+                    messages=[{"role": "system", "content": SUMMARY_PROMPT},
+                              {"role": "user", "content": text}],
+                    max_tokens=SUMMARY_TOKENS
+                )
+                if self.summary:
+                    self.tokens -= estimate_tokens(self.summary)
+                self.summary = {"role": "system", "content":
+                                "Summary of the conversation so far: " +
+                                response.choices[0].message.content}
+                self.tokens += estimate_tokens(self.summary)
+                _context_stats["summaries"] += 1
+                self.trim()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            _context_stats["summary_errors"] += 1
+            logging.warning("Cannot summarize the conversation: %s", e)
+        finally:
+            self.task = None
+
+    def close(self):
+        """ Stops summarizing """
+        if self.task:
+            self.task.cancel()
+
+
+def normalize(phrase):
+    """ Returns the words of a phrase, ignoring case and punctuation """
+    return NON_WORDS.sub(" ", phrase.lower()).strip()
+
 
 class ChatGPT:
     """ Class that implements ChatGPT communication """
@@ -34,31 +174,180 @@ class ChatGPT:
         self.api = AsyncOpenAI(api_key=api_key)
         self.contexts = {}
 
-    def create_call(self, b2b_key, hint=None):
+    def create_call(self, b2b_key, hint=None, max_tokens=CONTEXT_TOKENS,
+                    summarize=False):
         """ Creates a ChatGPT context """
-        self.contexts[b2b_key] = []
         if not hint:
             hint = "Please answer with simple text messages."
-        self.contexts[b2b_key].append({"role": "system",
-                                       "content": hint})
+        self.contexts[b2b_key] = Conversation(self, hint, max_tokens,
+                                              summarize)
 
     def delete_call(self, b2b_key):
         """ Deletes a ChatGPT context """
-        self.contexts.pop(b2b_key)
-
-    async def handle(self, b2b_key, message):
-        """ Sends a ChatGPT message """
-        self.contexts[b2b_key].append({"role": "user", "content": message})
+        self.contexts.pop(b2b_key).close()
 
+    async def complete(self, messages, content):
+        """ Yields the sentences of the answer to messages, as soon as they
+        are generated; the text generated is appended to content """
+        segmenter = SentenceSegmenter()
         response = await self.api.chat.completions.create(
             model=self.model,
-            messages=self.contexts[b2b_key]
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
         )
+        async with response:
+            async for chunk in response:
+                if chunk.usage:
+                    _prompt_tokens.observe(chunk.usage.prompt_tokens)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                text = chunk.choices[0].delta.content
+                content.append(text)
+                for sentence in segmenter.feed(text):
+                    yield sentence
+        sentence = segmenter.flush()
+        if sentence:
+            yield sentence
+
+    @staticmethod
+    def add_answer(context, content):
+        """ Adds the text generated for an answer to a context """
+        # an interrupted answer is kept as far as it was generated
+        if content:
+            content = "".join(content)
+            context.append({"role": "assistant", "content": content})
+            logging.info("Assistant: %s", content)
+
+    async def stream(self, b2b_key, message):
+        """ Sends a ChatGPT message and yields the sentences of the answer,
+        as soon as they are generated """
+        context = self.contexts[b2b_key]
+        context.append({"role": "user", "content": message})
+        content = []
+        try:
+            async for sentence in self.complete(context.prompt(), content):
+                yield sentence
+        finally:
+            self.add_answer(context, content)
+
+
+class Speculation:
+    """ The answer to an interim transcript, generated in the background;
+    the context is only changed if the answer is used """
+
+    def __init__(self, chatgpt, b2b_key, phrase):
+        self.chatgpt = chatgpt
+        self.context = chatgpt.contexts[b2b_key]
+        self.version = self.context.version
+        self.message = {"role": "user", "content": phrase}
+        self.words = normalize(phrase)
+        self.started = time.monotonic()
+        self.content = []
+        self.failed = False
+        self.sentences = asyncio.Queue()
+        self.task = asyncio.create_task(
+            self.generate(self.context.prompt(self.message)))
+        _speculation_stats["started"] += 1
+
+    async def generate(self, messages):
+        """ Queues the sentences of the answer """
+        try:
+            async for sentence in self.chatgpt.complete(messages,
+                                                        self.content):
+                self.sentences.put_nowait(sentence)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Speculative answer failed: %s", e)
+            self.failed = True
+        finally:
+            self.sentences.put_nowait(None)
+
+    def matches(self, phrase):
+        """ Checks if the answer is valid for a phrase """
+        return not self.failed and \
+            self.context.version == self.version and \
+            normalize(phrase) == self.words
+
+    def cancel(self):
+        """ Drops the answer """
+        self.task.cancel()
+        _speculation_stats["wasted_chars"] += sum(map(len, self.content))
+
+    def adopt(self, phrase):
+        """ Returns the sentences of the answer, as if it was requested now
+        for the final phrase, and adds it to the context """
+        _speculation_stats["hits"] += 1
+        _speculation_lead.observe((time.monotonic() - self.started) * 1000)
+        self.context.append({"role": "user", "content": phrase})
+        return self.answer()
+
+    async def answer(self):
+        """ Yields the sentences of the answer """
+        try:
+            while True:
+                sentence = await self.sentences.get()
+                if sentence is None:
+                    break
+                yield sentence
+        finally:
+            self.task.cancel()
+            self.chatgpt.add_answer(self.context, self.content)
+
+
+class Speculator:
+    """ Answers the phrase being spoken once its interim transcript is
+    stable, so that the answer may be ready when the transcript is final """
+
+    def __init__(self, chatgpt, b2b_key, delay=SPECULATION_DELAY):
+        self.chatgpt = chatgpt
+        self.b2b_key = b2b_key
+        self.delay = delay / 1000
+        self.speculation = None
+        self.timer = None
+
+    def hypothesis(self, phrase):
+        """ Notes an interim transcript of the phrase being spoken """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.speculation and self.speculation.matches(phrase):
+            return
+        self.timer = asyncio.get_running_loop().call_later(
+            self.delay, self.speculate, phrase)
+
+    def speculate(self, phrase):
+        """ Starts answering a phrase, instead of the previous one """
+        self.timer = None
+        if self.speculation:
+            _speculation_stats["restarts"] += 1
+            self.speculation.cancel()
+            self.speculation = None
+        if self.b2b_key not in self.chatgpt.contexts:
+            # the call is being closed
+            return
+        self.speculation = Speculation(self.chatgpt, self.b2b_key, phrase)
+
+    def answer(self, phrase):
+        """ Returns the sentences of the answer to a final phrase, already
+        being generated if it was speculated """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        speculation, self.speculation = self.speculation, None
+        if speculation:
+            if speculation.matches(phrase):
+                return speculation.adopt(phrase)
+            _speculation_stats["misses"] += 1
+            speculation.cancel()
+        return self.chatgpt.stream(self.b2b_key, phrase)
 
-        role = response.choices[0].message.role
-        content = response.choices[0].message.content
-        self.contexts[b2b_key].append({"role": role, "content": content})
-        logging.info("Assistant: %s", content)
-        return content
+    def cancel(self):
+        """ Drops the speculation in progress, if any """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.speculation:
+            self.speculation.cancel()
+            self.speculation = None
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -33,6 +33,10 @@ class UnsupportedCodec(Exception):
 class GenericCodec(ABC):
     """ Generic Abstract class for a codec """
 
+    # whether consecutive payloads can be joined into a single chunk; each
+    # Opus packet has to be sent on its own, to be decodable
+    concatenable = False
+
     def __init__(self, params, ptime=20):
         self.params = params
         self.ptime = ptime
@@ -65,8 +69,9 @@ class Opus(GenericCodec):
         self.container = 'ogg'
 
     async def process_response(self, response, queue):
+        demuxer = OggOpus()
         async for data in response.aiter_bytes():
-            for packet in self.parse(data, None):
+            for packet in demuxer.feed(data):
                 queue.put_nowait(packet)
 
     def parse(self, data, leftovers):
@@ -76,9 +81,61 @@ class Opus(GenericCodec):
         return b'\xf8\xff\xfe'
 
 
+class Framer:
+    """ Splits a stream of audio into fixed size payloads
+
+    Complete frames are returned as views over the fed data, so only the
+    incomplete tail of each chunk is copied and kept for the next one.
+    """
+
+    def __init__(self, frame_len, silence_byte):
+        self.frame_len = frame_len
+        self.silence_byte = silence_byte
+        self.pending = bytearray()
+
+    def feed(self, data):
+        """ Adds audio and returns the complete frames """
+        if not isinstance(data, bytes):
+            # the caller may reuse the buffer
+            data = bytes(data)
+        view = memoryview(data)
+        frame_len = self.frame_len
+        frames = []
+        pos = 0
+        if self.pending:
+            pos = frame_len - len(self.pending)
+            self.pending += view[:pos]
+            if len(self.pending) < frame_len:
+                return frames
+            frames.append(bytes(self.pending))
+            self.pending.clear()
+        end = pos + (len(view) - pos) // frame_len * frame_len
+        frames.extend([view[i:i + frame_len]
+                       for i in range(pos, end, frame_len)])
+        if end < len(view):
+            self.pending += view[end:]
+        return frames
+
+    def flush(self):
+        """ Returns the last frame, padded with silence, if any """
+        if not self.pending:
+            return None
+        self.pending += self.silence_byte * (self.frame_len -
+                                             len(self.pending))
+        frame = bytes(self.pending)
+        self.pending.clear()
+        return frame
+
+    def reset(self):
+        """ Drops the incomplete frame """
+        self.pending.clear()
+
+
 class G711(GenericCodec):
     """ Generic G711 Codec handling """
 
+    concatenable = True
+
     def __init__(self, params):
         super().__init__(params)
 
@@ -88,31 +145,25 @@ class G711(GenericCodec):
         self.name = "g711"
 
     async def process_response(self, response, queue):
-        leftovers = b''
+        framer = self.get_framer()
         async for data in response.aiter_bytes():
-            packets, leftovers = self.parse(data, leftovers)
-            for packet in packets:
+            for packet in framer.feed(data):
                 queue.put_nowait(packet)
-        packet = self.parse(None, leftovers)
+        packet = framer.flush()
+        if packet:
+            queue.put_nowait(packet)
 
     def parse(self, data, leftovers):
-        chunk_size = self.get_payload_len()
-
+        framer = self.get_framer()
+        framer.pending += leftovers
         if not data:
-            data = leftovers
-            data += self.get_silence_byte() * (chunk_size - len(data))
-            return data
-
-        data = leftovers + data
-
-        chunks = [data[i:i + chunk_size]
-                  for i in range(0, len(data), chunk_size)]
-        if len(chunks[-1]) < chunk_size:
-            leftovers = chunks.pop()
-        else:
-            leftovers = b''
+            return framer.flush()
+        packets = framer.feed(data)
+        return packets, bytes(framer.pending)
 
-        return chunks, leftovers
+    def get_framer(self):
+        """ Returns a new framer for the codec's payloads """
+        return Framer(self.get_payload_len(), self.get_silence_byte())
 
     def get_silence(self):
         return self.get_silence_byte() * self.get_payload_len()
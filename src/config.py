@@ -64,8 +64,11 @@ class ConfigSection(dict):
     def getboolean(self, option, env=None, fallback=None):
         """ returns a boolean value from the configuration """
         val = self.get(option, env, None)
+        if isinstance(val, bool):
+            return val
         if not val:
             return fallback
+        val = str(val)
         if val.isnumeric():
             return int(val) != 0
         if val.lower() in ["yes", "true", "on"]:
@@ -23,6 +23,7 @@
 Module that implements Deepgram communcation
 """
 
+import time
 import logging
 import asyncio
 
@@ -33,11 +34,26 @@ from deepgram import (  # pylint: disable=import-error
     LiveTranscriptionEvents,
 )
 
+import metrics
 from ai import AIEngine
-from chatgpt_api import ChatGPT
+from chatgpt_api import ChatGPT, Speculator, CONTEXT_TOKENS, \
+    SPECULATION_DELAY
 from config import Config
 from codec import get_codecs, CODECS, UnsupportedCodec
 
+# sentences synthesized ahead of the one being played
+SYNTHESIS_AHEAD = 2
+
+# tolerance on the end of a word, which a final result may adjust
+WORD_END_SLACK = 0.1
+
+# time from the end of the caller's speech to the phrase being sent to the
+# LLM, by the event that ended the utterance
+endpoint_delay = {}
+metrics.register("deepgram_endpoint",
+                 lambda: {reason: stats.to_dict()
+                          for reason, stats in endpoint_delay.items()})
+
 
 class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
 
@@ -45,7 +61,7 @@ class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
 
     chatgpt = None
 
-    def __init__(self, call, cfg):
+    def __init__(self, call, cfg, logger=None):
 
         self.cfg = Config.get("deepgram", cfg)
         chatgpt_key = self.cfg.get(["chatgpt_key", "openai_key"],
@@ -70,34 +86,43 @@ class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
         self.tts = self.deepgram.speak.asyncrest.v("1")
         # used to serialize the speech events
         self.speech_lock = asyncio.Lock()
+        self.speech_tasks = set()
 
         self.buf = []
-        sentences = self.buf
-        call_ref = self
-        Deepgram.chatgpt.create_call(self.b2b_key, self.intro)
+        self.silence_timeout = int(self.cfg.get(
+            "silence_timeout_ms", "DEEPGRAM_SILENCE_TIMEOUT_MS", 800)) / 1000
+        self.endpoint_timer = None
+        # when the last result was received, and the audio it covered
+        self.last_result = (0, 0)
+        self.last_word_end = 0
+        Deepgram.chatgpt.create_call(
+            self.b2b_key, self.intro,
+            int(self.cfg.get("context_tokens", "DEEPGRAM_CONTEXT_TOKENS",
+                             CONTEXT_TOKENS)),
+            self.cfg.getboolean("context_summary",
+                                "DEEPGRAM_CONTEXT_SUMMARY", False))
+        self.speculator = None
+        if self.cfg.getboolean("speculative", "DEEPGRAM_SPECULATIVE", False):
+            self.speculator = Speculator(
+                Deepgram.chatgpt, self.b2b_key,
+                int(self.cfg.get("speculative_delay_ms",
+                                 "DEEPGRAM_SPECULATIVE_DELAY_MS",
+                                 SPECULATION_DELAY)))
 
-        async def on_text(__, result, **_):
-            sentence = result.channel.alternatives[0].transcript
-            if len(sentence) == 0:
-                return
-            if not result.is_final:
-                return
-            sentences.append(sentence)
-            if not sentence.endswith(("?", ".", "!")):
-                return
-            phrase = " ".join(sentences)
-            logging.info("Speaker: %s", phrase)
-            asyncio.create_task(call_ref.handle_phrase(phrase))
-            sentences.clear()
-
-        self.stt.on(LiveTranscriptionEvents.Transcript, on_text)
+        self.stt.on(LiveTranscriptionEvents.Transcript, self.on_text)
+        self.stt.on(LiveTranscriptionEvents.UtteranceEnd,
+                    self.on_utterance_end)
         self.transcription_options = LiveOptions(
             model=self.model,
             language=self.language,
             punctuate=True,
             filler_words=True,
             interim_results=True,
-            utterance_end_ms="1000",
+            endpointing=int(self.cfg.get("endpointing_ms",
+                                         "DEEPGRAM_ENDPOINTING_MS", 300)),
+            utterance_end_ms=str(self.cfg.get("utterance_end_ms",
+                                              "DEEPGRAM_UTTERANCE_END_MS",
+                                              1000)),
             encoding=self.codec.name,
             sample_rate=self.codec.sample_rate)
         # don't use sample_rate if we have a bitrate
@@ -114,6 +139,58 @@ class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
                 sample_rate=self.codec.sample_rate,
                 container=self.codec.container)
 
+    async def on_text(self, _, result, **__):
+        """ Collects the final transcripts of an utterance """
+        alternative = result.channel.alternatives[0]
+        sentence = alternative.transcript
+        if len(sentence) == 0:
+            return
+        self.last_result = (time.monotonic(), result.start + result.duration)
+        if alternative.words:
+            self.last_word_end = alternative.words[-1].end
+        if self.endpoint_timer:
+            self.endpoint_timer.cancel()
+            self.endpoint_timer = None
+        if result.is_final:
+            self.buf.append(sentence)
+            if result.speech_final:
+                self.end_utterance("speech_final")
+                return
+        if self.speculator:
+            self.speculator.hypothesis(" ".join(
+                self.buf if result.is_final else self.buf + [sentence]))
+        if self.buf:
+            # in case Deepgram does not detect the end of the utterance
+            self.endpoint_timer = asyncio.get_running_loop().call_later(
+                self.silence_timeout, self.end_utterance, "silence_timeout")
+
+    async def on_utterance_end(self, _, utterance_end, **__):
+        """ Ends the utterance after a gap in the words """
+        if utterance_end.last_word_end < self.last_word_end - WORD_END_SLACK:
+            # the caller already started talking again
+            return
+        self.end_utterance("utterance_end")
+
+    def end_utterance(self, reason):
+        """ Sends the phrase of the caller to the LLM """
+        if self.endpoint_timer:
+            self.endpoint_timer.cancel()
+            self.endpoint_timer = None
+        if not self.buf:
+            return
+        phrase = " ".join(self.buf)
+        self.buf.clear()
+        # the audio received after the last word, then the time since
+        received, audio_end = self.last_result
+        delay = time.monotonic() - received + \
+            max(0, audio_end - self.last_word_end)
+        stats = endpoint_delay.get(reason)
+        if not stats:
+            stats = endpoint_delay[reason] = metrics.LatencyStats()
+        stats.observe(delay * 1000)
+        logging.info("Speaker: %s", phrase)
+        self.handle_phrase(phrase)
+
     def choose_codec(self, sdp):
         """ Returns the preferred codec from a list """
         codecs = get_codecs(sdp)
@@ -134,19 +211,82 @@ class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
         """ Sends audio to Deepgram """
         await self.stt.send(audio)
 
-    async def process_speech(self, phrase):
-        """ Processes the speech received """
-        response = await self.tts.stream_raw({"text": phrase},
-                                             self.speak_options)
+    async def synthesize(self, text, synthesis):
+        """ Starts the synthesis of each sentence, as soon as it is
+        generated, and queues the requests in order """
+        try:
+            if isinstance(text, str):
+                await synthesis.put(asyncio.create_task(
+                    self.tts.stream_raw({"text": text}, self.speak_options)))
+            else:
+                async for sentence in text:
+                    await synthesis.put(asyncio.create_task(
+                        self.tts.stream_raw({"text": sentence},
+                                            self.speak_options)))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Cannot generate the answer: %s", e)
+        finally:
+            if not isinstance(text, str):
+                # stops the generation, if interrupted
+                await text.aclose()
+        await synthesis.put(None)
+
+    async def process_speech(self, text):
+        """ Plays a text, or the sentences of an answer while it is
+        generated; the next sentences are synthesized meanwhile """
+        synthesis = asyncio.Queue(SYNTHESIS_AHEAD)
+        producer = asyncio.create_task(self.synthesize(text, synthesis))
+        request = None
+        try:
+            request = await synthesis.get()
+            if request:
+                await request
+                self.drain_queue()
+            async with self.speech_lock:
+                while request:
+                    await self.codec.process_response(await request,
+                                                      self.queue)
+                    request = await synthesis.get()
+        finally:
+            producer.cancel()
+            # no request is queued once the producer is done
+            await asyncio.wait([producer])
+            if request:
+                await self.discard(request)
+            while not synthesis.empty():
+                request = synthesis.get_nowait()
+                if request:
+                    await self.discard(request)
+
+    @staticmethod
+    async def discard(request):
+        """ Cancels a synthesis request, or closes its response """
+        if not request.done():
+            request.cancel()
+        elif not request.cancelled() and not request.exception():
+            await request.result().aclose()
+
+    def schedule_speech(self, speech):
+        """ Runs the playing of a text, or of an answer, in the
+        background """
+        task = asyncio.create_task(speech)
+        self.speech_tasks.add(task)
+        task.add_done_callback(self.speech_tasks.discard)
+
+    def cancel_speech(self):
+        """ Stops generating, synthesizing and playing the phrases in
+        progress """
+        for task in self.speech_tasks:
+            task.cancel()
+
+    async def interrupt(self):
+        """ Stops synthesizing the phrases in progress """
+        self.cancel_speech()
         self.drain_queue()
-        async with self.speech_lock:
-            await self.codec.process_response(response, self.queue)
 
     def drain_queue(self):
         """ Drains the playback queue """
-        logging.info("Dropping %d packets", self.queue.qsize())
-        with self.queue.mutex:
-            self.queue.queue.clear()
+        logging.info("Dropping %d packets", self.queue.clear())
 
     async def start(self):
         """ Starts a Depgram connection """
@@ -154,15 +294,37 @@ class Deepgram(AIEngine):  # pylint: disable=too-many-instance-attributes
             return
 
         if self.intro:
-            asyncio.create_task(self.process_speech(self.intro))
+            self.schedule_speech(self.process_speech(self.intro))
 
-    async def handle_phrase(self, phrase):
-        """ handles the response of a phrase """
-        response = await Deepgram.chatgpt.handle(self.b2b_key, phrase)
-        asyncio.create_task(self.process_speech(response))
+    def handle_phrase(self, phrase):
+        """ Speaks the answer to a phrase, while it is generated; the
+        previous answer, if still in progress, is replaced """
+        previous = list(self.speech_tasks)
+        self.cancel_speech()
+        self.schedule_speech(self.answer(phrase, previous))
+
+    async def answer(self, phrase, previous):
+        """ Speaks the answer to a phrase, once the previous answers are
+        stopped, so that what they said is in the context first """
+        if previous:
+            await asyncio.wait(previous)
+        if self.speculator:
+            await self.process_speech(self.speculator.answer(phrase))
+        else:
+            await self.process_speech(Deepgram.chatgpt.stream(self.b2b_key,
+                                                              phrase))
 
     async def close(self):
         """ closes the Deepgram session """
+        if self.endpoint_timer:
+            self.endpoint_timer.cancel()
+        if self.speculator:
+            self.speculator.cancel()
+        # stop the ChatGPT and TTS streams of the call
+        tasks = list(self.speech_tasks)
+        self.cancel_speech()
+        if tasks:
+            await asyncio.wait(tasks)
         Deepgram.chatgpt.delete_call(self.b2b_key)
         await self.stt.finish()
 
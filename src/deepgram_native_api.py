@@ -25,13 +25,11 @@ OpenAI WS communication
 
 import json
 import logging
-import asyncio
-from queue import Empty
-from websockets.asyncio.client import connect
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 from ai import AIEngine
 from codec import get_codecs, CODECS, UnsupportedCodec
 from config import Config
+import ws_pool
 
 DEEPGRAM_VOICE_AGENT_URL = "wss://agent.deepgram.com/agent"
 
@@ -40,8 +38,10 @@ class DeepgramNative(AIEngine):  # pylint: disable=too-many-instance-attributes
 
     """ Implements WS communication with Deepgram """
 
-    def __init__(self, call, cfg):
+    def __init__(self, call, cfg, logger=None):
         self.codec = self.choose_codec(call.sdp)
+        self.framer = self.codec.get_framer()
+        self.muted = False
         self.queue = call.rtp
         self.call = call
         self.ws = None
@@ -84,9 +84,11 @@ class DeepgramNative(AIEngine):  # pylint: disable=too-many-instance-attributes
         deepgram_headers = {
                 "Authorization": f"Token {self.key}"
         }
-        self.ws = await connect(DEEPGRAM_VOICE_AGENT_URL, additional_headers=deepgram_headers)
         try:
-            resp = json.loads(await self.ws.recv())
+            self.ws, greeting = await ws_pool.acquire(
+                "deepgram_native", DEEPGRAM_VOICE_AGENT_URL,
+                deepgram_headers, keepalive={"type": "KeepAlive"})
+            resp = json.loads(greeting)
             logging.info(f"Connected to Deepgram: {resp}")
         except ConnectionClosedOK:
             logging.info("WS Connection with Deepgram is closed")
@@ -169,43 +171,42 @@ class DeepgramNative(AIEngine):  # pylint: disable=too-many-instance-attributes
 
     async def handle_command(self):  # pylint: disable=too-many-branches
         """ Handles a command from the server """
-        leftovers = b''
         async for smsg in self.ws:
             try:
                 if isinstance(smsg, bytes):
-                    packets, leftovers = await self.run_in_thread(
-                        self.codec.parse, smsg, leftovers)
-                    for packet in packets:
+                    if self.muted:
+                        continue
+                    # framing costs less than a hop to a thread
+                    for packet in self.framer.feed(smsg):
                         self.queue.put_nowait(packet)
                 else:
                     msg = json.loads(smsg)
-                    logging.info(f"Received message: {msg}")
+                    logging.info("Received message: %s", msg)
                     t = msg["type"]
                     if t == "AgentAudioDone":
-                        if len(leftovers) > 0:
-                            packet = await self.run_in_thread(
-                                self.codec.parse, None, leftovers)
+                        packet = self.framer.flush()
+                        if packet:
                             self.queue.put_nowait(packet)
-                            leftovers = b''
                     elif t == "EndOfThought":
                         self.drain_queue()
+                    if t in ["UserStartedSpeaking", "AgentAudioDone"]:
+                        # the audio of the interrupted answer stops here
+                        self.muted = False
             except Exception as e:
                 logging.error(f"Unexpected error while processing message: {type(e)}: {e}")
                 raise
 
     def drain_queue(self):
         """ Drains the playback queue """
-        count = 0
-        try:
-            while self.queue.get_nowait():
-                count += 1
-        except Empty:
-            if count > 0:
-                logging.info("dropping %d packets", count)
+        self.framer.reset()
+        count = self.queue.clear()
+        if count > 0:
+            logging.info("dropping %d packets", count)
 
-    async def run_in_thread(self, func, *args):
-        """ Runs a function in a thread """
-        return await asyncio.to_thread(func, *args)
+    async def interrupt(self):
+        """ Drops the agent's audio until it stops the interrupted answer """
+        self.framer.reset()
+        self.muted = True
 
     async def send(self, audio):
         """ Sends audio to OpenAI """
@@ -222,6 +223,7 @@ class DeepgramNative(AIEngine):  # pylint: disable=too-many-instance-attributes
             self.terminate_call()
 
     async def close(self):
-        await self.ws.close()
+        if self.ws:
+            await self.ws.close()
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -22,77 +22,76 @@
 """ Main module that starts the Deepgram AI integration """
 
 import json
+import time
 import signal
 import asyncio
 import logging
-import requests
+import copy
 
 from opensips.mi import OpenSIPSMI, OpenSIPSMIException
 from opensips.event import OpenSIPSEventHandler, OpenSIPSEventException
 from aiortc.sdp import SessionDescription
 
-from call import Call
+from call import Call, bind_media_socket, release_media_socket, \
+    observe_setup
 from config import Config
 from codec import UnsupportedCodec
 from utils import UnknownSIPUser
 import utils as utils
+import metrics
+from bot_config import BotConfigClient
+from mi import AsyncMI
+import api_tools
+import ws_pool
 
 
 mi_cfg = Config.get("opensips")
 mi_ip = mi_cfg.get("ip", "MI_IP", "127.0.0.1")
 mi_port = int(mi_cfg.get("port", "MI_PORT", "8080"))
 
+# the synchronous connection is only used at startup, to subscribe for events
 mi_conn = OpenSIPSMI(conn="datagram", datagram_ip=mi_ip, datagram_port=mi_port)
+mi = AsyncMI(mi_ip, mi_port,
+             timeout=float(mi_cfg.get("timeout", "MI_TIMEOUT", "1")),
+             retries=int(mi_cfg.get("retries", "MI_RETRIES", "2")))
 
 calls = {}
 
+# the task running the engine
+main_task = None  # pylint: disable=invalid-name
+
+bot_configs = None
+if Config.engine("api_url", "API_URL"):
+    bot_configs = BotConfigClient(
+        Config.engine("api_url", "API_URL"),
+        Config.engine("api_key", "API_KEY"),
+        ttl=float(Config.engine("api_cache_ttl", "API_CACHE_TTL", "60")),
+        stale_ttl=float(Config.engine("api_cache_stale", "API_CACHE_STALE",
+                                      "3600")),
+        negative_ttl=float(Config.engine("api_negative_ttl",
+                                         "API_NEGATIVE_TTL", "30")),
+        timeout=float(Config.engine("api_timeout", "API_TIMEOUT", "10")),
+        snapshot=Config.engine("api_snapshot", "API_SNAPSHOT"),
+        max_entries=int(Config.engine("api_cache_size", "API_CACHE_SIZE",
+                                      "10000")))
+
 
 def mi_reply(key, method, code, reason, body=None):
-    """ Replies to the server """
+    """ Replies to the server in the background; the returned task can be
+    awaited to find out whether the reply succeeded """
     params = {'key': key,
               'method': method,
               'code': code,
               'reason': reason}
     if body:
         params["body"] = body
-    mi_conn.execute('ua_session_reply', params)
+    return mi.send('ua_session_reply', params)
 
 
-def fetch_bot_config(api_url, bot, api_key=None, bot_domain=None):
-    """
-    Sends a GET request to the API to fetch the bot configuration.
-    
-    :param api_url: The base URL of the API
-    :param bot: The bot identifier
-    :param api_key: Optional API key for authentication
-    :param bot_domain: Optional domain for the bot
-    :return: Bot configuration dictionary or None if failed
-    """
-    try:
-        headers = {}
-        if api_key:
-            headers['Authorization'] = f'Token {api_key}'
-        
-        # Add domain to request if provided
-        params = {"bot": bot}
-        if bot_domain:
-            params['domain'] = bot_domain
-            
-        response = requests.get(f"{api_url}", headers=headers, params=params, timeout=10)
-        response.raise_for_status()
-        logging.info(f"Response from API: {response.json()}")
-        return response.json()
-    except Exception as e:
-        logging.exception(f"Error during API call: {e}")
-        return None
-
-
-def parse_params(params):
+async def parse_params(params):
     """ Parses paraameters received in a call """
     flavor = None
     extra_params = None
-    api_url = Config.engine("api_url", "API_URL")
-    api_key = Config.engine("api_key", "API_KEY")
     bot_header = Config.engine("bot_header", "BOT_HEADER", "To")
     cfg = None
     
@@ -119,11 +118,12 @@ def parse_params(params):
     if extra_params and flavor and flavor in extra_params:
         cfg = extra_params[flavor]
     # Otherwise, if we have bot_header and API URL, fetch bot config from API
-    elif bot and api_url:
-        bot_data = fetch_bot_config(api_url, bot, api_key, bot_domain)
+    elif bot and bot_configs:
+        bot_data = await bot_configs.get(bot, bot_domain)
         if bot_data:
             flavor = bot_data.get('flavor')
-            cfg = bot_data[flavor]
+            # the cached configuration is shared by all the calls
+            cfg = copy.deepcopy(bot_data[flavor])
         else:
             return None
     
@@ -141,10 +141,65 @@ def parse_params(params):
     return flavor, to, user, cfg, bot
 
 
+async def handle_new_call(key, method, params, sdp, start):
+    """ Sets up a new call, without blocking the processing of other events
+
+    The media socket does not depend on the bot, thus it is bound before
+    the bot is resolved; the AI engine starts connecting to its provider
+    while the call is being answered. Each stage is timed.
+    """
+    sock = None
+    new_call = None
+    answered = False
+    try:
+        stage = time.perf_counter()
+        sock = bind_media_socket()
+        stage = observe_setup("bind", stage)
+        result = await parse_params(params)
+        stage = observe_setup("resolve_bot", stage)
+        if result:
+            flavor, to, user, cfg, bot = result
+        else:
+            mi_reply(key, method, 404, 'Bot Not Found')
+            return
+        new_call = Call(key, mi, sdp, flavor, to, user, cfg, bot,
+                        sock=sock, setup_start=start)
+        calls[key] = new_call
+        stage = observe_setup("create_call", stage)
+        await mi_reply(key, method, 200, 'OK', new_call.get_body())
+        answered = True
+        observe_setup("reply", stage)
+        observe_setup("total", start)
+    except UnsupportedCodec:
+        mi_reply(key, method, 488, 'Not Acceptable Here')
+    except UnknownSIPUser:
+        logging.exception("Unknown SIP user %s")
+        mi_reply(key, method, 404, 'Not Found')
+    except OpenSIPSMIException:
+        # the failure has already been logged
+        mi_reply(key, method, 500, 'Server Internal Error')
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.exception("Error creating call %s", e)
+        mi_reply(key, method, 500, 'Server Internal Error')
+    finally:
+        if not new_call:
+            if sock:
+                release_media_socket(sock)
+        elif not answered and calls.get(key) is new_call:
+            # not answered: release the media and the AI engine, unless a
+            # BYE already closed the call
+            calls.pop(key)
+            try:
+                await new_call.close()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Error closing call %s", key)
+
+
 def handle_call(call, key, method, params):
     """ Handles a SIP call """
 
     if method == 'INVITE':
+        start = time.perf_counter()
         if 'body' not in params:
             mi_reply(key, method, 415, 'Unsupported Media Type')
             return
@@ -162,34 +217,13 @@ def handle_call(call, key, method, params):
                 call.resume()
             else:
                 call.pause()
-            try:
-                mi_reply(key, method, 200, 'OK', call.get_body())
-            except OpenSIPSMIException:
-                logging.exception("Error sending response")
+            mi_reply(key, method, 200, 'OK', call.get_body())
             return
 
-        try:
-            result = parse_params(params)
-            if result:
-                flavor, to, user, cfg, bot = result
-            else:
-                mi_reply(key, method, 404, 'Bot Not Found')
-                return
-            new_call = Call(key, mi_conn, sdp, flavor, to, user, cfg, bot)
-            calls[key] = new_call
-            mi_reply(key, method, 200, 'OK', new_call.get_body())
-        except UnsupportedCodec:
-            mi_reply(key, method, 488, 'Not Acceptable Here')
-        except UnknownSIPUser:
-            logging.exception("Unknown SIP user %s")
-            mi_reply(key, method, 404, 'Not Found')
-        except OpenSIPSMIException:
-            logging.exception("Error sending response")
-            mi_reply(key, method, 500, 'Server Internal Error')
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            logging.exception("Error creating call %s", e)
-            mi_reply(key, method, 500, 'Server Internal Error')
-    
+        observe_setup("parse_sdp", start)
+        asyncio.create_task(handle_new_call(key, method, params, sdp, start))
+        return
+
     elif method == 'NOTIFY':
         mi_reply(key, method, 200, 'OK')
         sub_state = utils.get_header(params, "Subscription-State")
@@ -201,16 +235,13 @@ def handle_call(call, key, method, params):
         calls.pop(key, None)
     
     if not call:
-        try:
-            mi_reply(key, method, 405, 'Method not supported')
-        except OpenSIPSMIException as e:
-            logging.error(f"Failed to send reply {key}, {method}: {e}")
+        mi_reply(key, method, 405, 'Method not supported')
         return
 
 
 def udp_handler(data):
-    logging.info(f"Received event: {data}")
     """ UDP handler of events received """
+    logging.info("Received event: %s", data)
 
     if 'params' not in data:
         return
@@ -238,7 +269,9 @@ def udp_handler(data):
 async def shutdown(s, loop, event):
     """ Called when the program is shutting down """
     logging.info("Received exit signal %s...", s)
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    # the main task is only stopped once everything is cleaned up
+    tasks = [t for t in asyncio.all_tasks()
+             if t not in (asyncio.current_task(), main_task)]
     for task in tasks:
         task.cancel()
     logging.info("Cancelling %d outstanding tasks", len(tasks))
@@ -247,18 +280,29 @@ async def shutdown(s, loop, event):
             continue
         await call.close()
     try:
-        event.unsubscribe()
+        if event:
+            event.unsubscribe()
     except OpenSIPSEventException as e:
         logging.error("Error unsubscribing from event: %s", e)
     except OpenSIPSMIException as e:
         logging.error("Error unsubscribing from event: %s", e)
     await asyncio.gather(*tasks, return_exceptions=True)
-    loop.stop()
+    if bot_configs:
+        await bot_configs.close()
+    await api_tools.close_sessions()
+    await ws_pool.close_pools()
+    mi.close()
     logging.info("Shutdown complete.")
+    if main_task:
+        main_task.cancel()
+    else:
+        loop.stop()
 
 
 async def async_run():
     """ Main function """
+    global main_task  # pylint: disable=global-statement
+    main_task = asyncio.current_task()
     host_ip = Config.engine("event_ip", "EVENT_IP", "127.0.0.1")
     port = int(Config.engine("event_port", "EVENT_PORT", "0"))
 
@@ -273,6 +317,10 @@ async def async_run():
 
     logging.info("Starting server at %s:%hu", host_ip, port)
 
+    stats_interval = int(Config.engine("stats_interval", "STATS_INTERVAL", "60"))
+    if stats_interval > 0:
+        asyncio.create_task(metrics.report(stats_interval))
+
     loop = asyncio.get_running_loop()
     stop = loop.create_future()
 
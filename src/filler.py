@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Pre-encoded prompts played while the caller waits """
+
+import wave
+import logging
+
+from transcode import Transcoder
+
+_prompts = {}
+
+
+def _load(path, codec):
+    with wave.open(path, "rb") as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise ValueError("expected a mono, 16-bit PCM WAV file")
+        rate = wav.getframerate()
+        pcm = wav.readframes(wav.getnframes())
+    framer = codec.get_framer()
+    frames = [bytes(f) for f in
+              framer.feed(Transcoder(codec.name, rate).encode(pcm))]
+    last = framer.flush()
+    if last:
+        frames.append(bytes(last))
+    return tuple(frames)
+
+
+def load_filler(path, codec):
+    """ Returns the frames of a prompt, encoded with the codec of a call;
+    each prompt is only encoded once per codec """
+    key = (path, codec.name, codec.get_payload_len())
+    if key in _prompts:
+        return _prompts[key]
+    if not Transcoder.supports(codec.name):
+        logging.warning("cannot play %s with %s codec", path, codec.name)
+        frames = ()
+    else:
+        try:
+            frames = _load(path, codec)
+        except (OSError, EOFError, ValueError, wave.Error) as e:
+            logging.error("cannot load filler prompt %s: %s", path, e)
+            frames = ()
+    _prompts[key] = frames
+    return frames
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Forwards the inbound audio of a call to the AI engine """
+
+import asyncio
+from collections import deque
+
+import metrics
+
+_stats = {"chunks": 0, "frames": 0, "dropped": 0}
+metrics.register("inbound_audio", lambda: dict(_stats))
+
+
+class AudioForwarder():
+    """ Coalesces inbound frames into chunks and sends them in order; with
+    a single frame per chunk, e.g. for Opus, each frame is sent as is
+
+    Chunks are converted to linear PCM when the engine requires it. Frames
+    are buffered in a bounded queue; when the engine cannot keep up,
+    the oldest frames are dropped.
+    """
+
+    def __init__(self, ai, frames_per_chunk, max_frames, logger,
+                 transcoder=None):
+        self.ai = ai
+        self.transcoder = transcoder
+        self.logger = logger
+        self.frames_per_chunk = max(1, frames_per_chunk)
+        self.max_frames = max(self.frames_per_chunk, max_frames)
+        self.frames = deque()
+        self.event = asyncio.Event()
+        self.dropped = 0
+        self.flushing = False
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, frame):
+        """ Queues a frame to be sent to the engine """
+        if len(self.frames) >= self.max_frames:
+            self.frames.popleft()
+            self.dropped += 1
+            _stats["dropped"] += 1
+            if self.dropped == 1:
+                self.logger.warning("AI engine is not keeping up, "
+                                    "dropping inbound audio")
+        self.frames.append(frame)
+        if len(self.frames) >= self.frames_per_chunk:
+            self.event.set()
+
+    async def run(self):
+        """ Sends the buffered audio to the engine """
+        frames = self.frames
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            while len(frames) >= self.frames_per_chunk or \
+                    (self.flushing and frames):
+                count = min(len(frames), self.frames_per_chunk)
+                if count == 1:
+                    chunk = frames.popleft()
+                else:
+                    chunk = b''.join([frames.popleft() for _ in range(count)])
+                _stats["chunks"] += 1
+                _stats["frames"] += count
+                try:
+                    if self.transcoder:
+                        chunk = self.transcoder.decode(chunk)
+                    await self.ai.send(chunk)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    self.logger.exception("error sending audio to AI")
+            self.flushing = False
+
+    def flush(self):
+        """ Sends the buffered frames without waiting for a full chunk """
+        if self.frames:
+            self.flushing = True
+            self.event.set()
+
+    def close(self):
+        """ Stops forwarding audio """
+        self.task.cancel()
+        if self.dropped:
+            self.logger.info("dropped %d inbound frames", self.dropped)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
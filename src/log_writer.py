@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Writes the log records from a dedicated thread, so that formatting and
+file I/O never run on the event loop
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import (QueueHandler, RotatingFileHandler,
+                              TimedRotatingFileHandler)
+
+import metrics
+
+# records written before the dirty files are flushed, at most
+MAX_BATCH = 256
+
+_STOP = object()
+_writer = None  # pylint: disable=invalid-name
+
+
+class BatchedFlushMixin:
+    """ Leaves the flushing of a stream handler to the writer thread """
+
+    dirty = False
+
+    def flush(self):
+        """ Marks the records written to be flushed by the writer thread """
+        self.dirty = True
+
+    def sync(self):
+        """ Flushes the records written since the last sync """
+        if self.dirty:
+            self.dirty = False
+            logging.StreamHandler.flush(self)
+
+
+class AppFileHandler(BatchedFlushMixin, TimedRotatingFileHandler):
+    """ Daily rotated application log """
+
+
+class CallFileHandler(BatchedFlushMixin, RotatingFileHandler):
+    """ Log of a call; the file, and its directory, are only created by the
+    writer thread, when the first record is written """
+
+    def __init__(self, filename, max_bytes=10*1024*1024, backup_count=3):
+        super().__init__(filename, maxBytes=max_bytes,
+                         backupCount=backup_count, encoding='utf-8',
+                         delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class ProcessQueueHandler(QueueHandler):
+    """ Sends the records to another process, which writes them """
+
+    def sync(self):
+        """ Nothing to flush, the queue is fed by its own thread """
+
+
+class QueueingHandler(logging.Handler):
+    """ Passes the records to the writer thread, unformatted """
+
+    def __init__(self, writer, target):
+        super().__init__(target.level)
+        self.writer = writer
+        self.target = target
+
+    def emit(self, record):
+        self.writer.put(self.target, record)
+
+    def close(self):
+        self.writer.call(self.target.close)
+        super().close()
+
+
+class LogWriter(threading.Thread):  # pylint: disable=too-many-instance-attributes
+    """ Formats and writes the queued records to their handlers
+
+    Messages are formatted by the writer, so a record that is dropped costs
+    almost nothing. Records are dropped when the queue is full, or when a
+    message is logged more than max_rate times per second; messages longer
+    than max_len are truncated. Files are flushed once the queue is empty,
+    or every MAX_BATCH records.
+    """
+
+    def __init__(self, queue_size=10000, max_rate=100, max_len=4096):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue.Queue(queue_size)
+        self.max_rate = max_rate
+        self.max_len = max_len
+        self.window = 0
+        self.rates = {}
+        self.stats = {"written": 0, "dropped_full": 0, "dropped_rate": 0,
+                      "truncated": 0}
+
+    def put(self, target, record):
+        """ Queues a record, unless it is over the caps """
+        if self.max_rate:
+            now = int(time.monotonic())
+            if now != self.window:
+                self.window = now
+                self.rates.clear()
+            # with lazy formatting, the message is the call site's template;
+            # the records of different calls are limited separately
+            key = (record.name, getattr(record, "call_log_file", None),
+                   record.msg if isinstance(record.msg, str)
+                   else type(record.msg))
+            count = self.rates.get(key, 0) + 1
+            self.rates[key] = count
+            if count > self.max_rate:
+                self.stats["dropped_rate"] += 1
+                return
+        try:
+            self.queue.put_nowait((target, record))
+        except queue.Full:
+            self.stats["dropped_full"] += 1
+
+    def call(self, func):
+        """ Runs func in the writer thread, after the queued records """
+        try:
+            self.queue.put((func, None), timeout=1)
+        except queue.Full:
+            self.stats["dropped_full"] += 1
+
+    def cap(self, record):
+        """ Truncates the message of a record to max_len """
+        msg = record.getMessage()
+        if len(msg) > self.max_len:
+            self.stats["truncated"] += 1
+            msg = f"{msg[:self.max_len]}... ({len(msg) - self.max_len} more)"
+        # formatted only once
+        record.msg = msg
+        record.args = None
+
+    def run(self):
+        dirty = set()
+        batch = 0
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            target, record = item
+            if record is None:
+                for handler in dirty:
+                    handler.sync()
+                dirty.clear()
+                target()
+            else:
+                try:
+                    if self.max_len:
+                        self.cap(record)
+                    target.handle(record)
+                    self.stats["written"] += 1
+                except Exception:  # pylint: disable=broad-exception-caught
+                    target.handleError(record)
+                dirty.add(target)
+                batch += 1
+            if batch >= MAX_BATCH or self.queue.empty():
+                for handler in dirty:
+                    handler.sync()
+                dirty.clear()
+                batch = 0
+        for handler in dirty:
+            handler.sync()
+
+    def stop(self):
+        """ Writes the queued records and stops the thread """
+        self.queue.put(_STOP)
+        self.join()
+
+    def get_stats(self):
+        """ Returns the writer statistics """
+        return {**self.stats, "queued": self.queue.qsize()}
+
+
+def start(queue_size=10000, max_rate=100, max_len=4096):
+    """ Starts the writer thread of the process """
+    global _writer  # pylint: disable=global-statement
+    _writer = LogWriter(queue_size, max_rate, max_len)
+    _writer.start()
+    atexit.register(_writer.stop)
+    metrics.register("logging", _writer.get_stats)
+
+
+def stop():
+    """ Writes the queued records and stops the writer thread; needed by the
+    processes that exit without running the atexit handlers """
+    global _writer  # pylint: disable=global-statement
+    if _writer:
+        atexit.unregister(_writer.stop)
+        _writer.stop()
+        _writer = None
+
+
+def call(func):
+    """ Runs func once the records logged so far are written """
+    if _writer:
+        _writer.call(func)
+    else:
+        func()
+
+
+def get_handler(target):
+    """ Returns a handler writing to target from the writer thread, or
+    target itself when the writer is not running """
+    if not _writer:
+        return target
+    return QueueingHandler(_writer, target)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -24,9 +24,10 @@
 import os
 import sys
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import argparse
 from config import Config
+import log_writer
+from log_writer import AppFileHandler
 from version import __version__
 
 
@@ -53,23 +54,39 @@ parser.add_argument("-l", "--loglevel",
 parsed_args = parser.parse_args()
 Config.init(parsed_args.config)
 
-os.makedirs('logs', exist_ok=True)
-log_handler = TimedRotatingFileHandler(
-    'logs/app.log', when='midnight', interval=1, backupCount=7, encoding='utf-8'
-)
-log_handler.setFormatter(logging.Formatter('%(asctime)s - tid: %(thread)d - %(levelname)s - %(message)s'))
+# the formats do not use the caller or the process of a record, so do not
+# spend time collecting them for each record
+logging._srcfile = None  # pylint: disable=protected-access
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# records are formatted and written by a dedicated thread
+log_writer.start(
+    int(Config.engine("log_queue_size", "LOG_QUEUE_SIZE", "10000")),
+    int(Config.engine("log_rate", "LOG_RATE", "100")),
+    int(Config.engine("log_max_len", "LOG_MAX_LEN", "4096")))
 
 # Configure root logger for general application logs only
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, parsed_args.loglevel))
-logger.addHandler(log_handler)
-
-# Prevent call-specific loggers from propagating to root logger
-logging.getLogger('call_').setLevel(logging.CRITICAL)
-logging.getLogger('call_').propagate = False
 
 if __name__ == '__main__':
-    from engine import run
-    run()
+    # the worker processes import this module too, but send their records
+    # to the supervisor, which is the only one writing (and rotating) app.log
+    os.makedirs('logs', exist_ok=True)
+    log_handler = AppFileHandler(
+        'logs/app.log', when='midnight', interval=1, backupCount=7, encoding='utf-8'
+    )
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - tid: %(thread)d - %(levelname)s - %(message)s'))
+    logger.addHandler(log_writer.get_handler(log_handler))
+    workers = int(Config.engine("workers", "WORKERS", "1"))
+    if workers > 1:
+        # the supervisor shards the calls to worker processes, each running
+        # its own engine
+        from workers import run
+        run(workers)
+    else:
+        from engine import run
+        run()
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Runtime statistics exported by the engine components """
+
+import json
+import asyncio
+import logging
+
+_sources = {}
+
+
+class LatencyStats:
+    """ Keeps the count, average and maximum of a series of values (ms) """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Records a new value """
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        """ Returns the statistics as a dictionary """
+        avg = self.total / self.count if self.count else 0.0
+        return {"count": self.count,
+                "avg": round(avg, 3),
+                "max": round(self.max, 3)}
+
+
+def register(name, source):
+    """ Registers a callable that returns the statistics of a component """
+    _sources[name] = source
+
+
+def unregister(name):
+    """ Removes a statistics source """
+    _sources.pop(name, None)
+
+
+def snapshot():
+    """ Returns the current statistics of all the registered components """
+    return {name: source() for name, source in _sources.items()}
+
+
+async def report(interval):
+    """ Periodically logs the statistics of all the components """
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("stats: %s", json.dumps(snapshot()))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
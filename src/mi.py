@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Asynchronous OpenSIPS MI Datagram client """
+
+import json
+import time
+import asyncio
+import logging
+from itertools import count
+
+from opensips.mi import OpenSIPSMIException
+
+import metrics
+
+# each request earns this fraction of a retry
+RETRY_RATIO = 0.1
+# retries that can be accumulated in the budget
+MAX_RETRY_TOKENS = 10
+# commands without side effects, which can be sent again on timeout
+IDEMPOTENT_COMMANDS = {"which", "version", "uptime", "ps", "get_statistics",
+                       "list_statistics", "ua_session_list"}
+
+
+class MIProtocol(asyncio.DatagramProtocol):
+    """ Passes the replies received from OpenSIPS to the client """
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.reply_received(data)
+
+    def error_received(self, exc):
+        logging.warning("MI socket error: %s", exc)
+
+
+class AsyncMI():  # pylint: disable=too-many-instance-attributes
+    """ Runs MI commands without blocking the event loop
+
+    All the commands share a single socket: many requests can be in flight
+    at the same time, and the replies are matched to them by their JSON-RPC
+    id. An idempotent command that is not answered in time is retransmitted,
+    as long as the retry budget allows it; the budget grows with each
+    request, so that retries cannot flood an OpenSIPS that is already
+    overloaded. Other commands, such as the replies, updates and
+    terminations of a session, are never sent twice: a slow reply does not
+    mean the first request failed, and a retry could e.g. send a duplicate
+    SIP reply or REFER.
+    """
+
+    def __init__(self, ip, port, timeout=1.0, retries=2):
+        self.address = (ip, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.connecting = None
+        self.ids = count(1)
+        self.pending = {}
+        self.retry_tokens = MAX_RETRY_TOKENS
+        self.latency = {}
+        self.stats = {"requests": 0, "errors": 0, "timeouts": 0,
+                      "retries": 0, "late_replies": 0}
+        metrics.register("mi", self.get_stats)
+
+    async def connect(self):
+        """ Opens the socket used to talk to OpenSIPS """
+        if self.transport:
+            return
+        if not self.connecting:
+            loop = asyncio.get_running_loop()
+            self.connecting = asyncio.ensure_future(
+                loop.create_datagram_endpoint(lambda: MIProtocol(self),
+                                              remote_addr=self.address))
+        try:
+            transport, _ = await asyncio.shield(self.connecting)
+        except OSError as e:
+            self.connecting = None
+            raise OpenSIPSMIException(f"Error with connection: {e}. "
+                                      "Is OpenSIPS running?") from e
+        self.transport = transport
+
+    def reply_received(self, data):
+        """ Resolves the request a reply belongs to """
+        try:
+            reply = json.loads(data)
+            future = self.pending.pop(reply["id"], None)
+        except (ValueError, KeyError, TypeError):
+            logging.warning("invalid MI reply: %s", data)
+            return
+        if not future:
+            self.stats["late_replies"] += 1
+            return
+        if not future.done():
+            future.set_result(reply)
+
+    def spend_retry(self):
+        """ Takes a retry from the budget, if there is any left """
+        if self.retry_tokens < 1:
+            return False
+        self.retry_tokens -= 1
+        return True
+
+    async def execute(self, cmd, params=None, idempotent=None):
+        """ Executes a command and returns its result; unless told otherwise,
+        only the commands in IDEMPOTENT_COMMANDS are retried """
+        if idempotent is None:
+            idempotent = cmd in IDEMPOTENT_COMMANDS
+        retries = self.retries if idempotent else 0
+        await self.connect()
+        self.stats["requests"] += 1
+        self.retry_tokens = min(self.retry_tokens + RETRY_RATIO,
+                                MAX_RETRY_TOKENS)
+        req_id = str(next(self.ids))
+        data = json.dumps({'jsonrpc': '2.0',
+                           'id': req_id,
+                           'method': cmd,
+                           'params': params if params else {}}).encode()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[req_id] = future
+        start = time.perf_counter()
+        attempt = 0
+        try:
+            while True:
+                self.transport.sendto(data)
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(future),
+                                                   self.timeout)
+                    break
+                except asyncio.TimeoutError:
+                    if attempt >= retries or not self.spend_retry():
+                        self.stats["timeouts"] += 1
+                        raise OpenSIPSMIException(
+                            f"Error with connection: {cmd} timed out. "
+                            "Is OpenSIPS running?") from None
+                    attempt += 1
+                    self.stats["retries"] += 1
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.pending.pop(req_id, None)
+        self.latency.setdefault(cmd, metrics.LatencyStats()).observe(
+            (time.perf_counter() - start) * 1000)
+        error = reply.get('error')
+        if isinstance(error, dict):
+            self.stats["errors"] += 1
+            raise OpenSIPSMIException(
+                f"Error executing command: {error.get('code', 500)}: "
+                f"{error.get('message')}")
+        return reply.get('result')
+
+    def send(self, cmd, params=None, idempotent=None):
+        """ Executes a command in the background, logging its failure """
+        def log_failure(task):
+            if not task.cancelled() and task.exception():
+                logging.error("MI command %s failed: %s",
+                              cmd, task.exception())
+
+        task = asyncio.create_task(self.execute(cmd, params, idempotent))
+        task.add_done_callback(log_failure)
+        return task
+
+    def get_stats(self):
+        """ Returns the requests statistics and latencies """
+        return {**self.stats,
+                "in_flight": len(self.pending),
+                "retry_budget": round(self.retry_tokens, 1),
+                "latency_ms": {cmd: stats.to_dict()
+                               for cmd, stats in self.latency.items()}}
+
+    def close(self):
+        """ Closes the socket and fails the pending commands """
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        self.connecting = None
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
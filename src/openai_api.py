@@ -23,21 +23,52 @@
 OpenAI WS communication
 """
 
+import re
 import json
 import base64
 import logging
-import requests
 import asyncio
-from queue import Empty
-from websockets.asyncio.client import connect
+from binascii import a2b_base64
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 from ai import AIEngine
 from codec import get_codecs, CODECS, UnsupportedCodec
 from config import Config
+from api_tools import ApiFunction
+from filler import load_filler
+import ws_pool
+
+
+# a faster JSON parser is used, if installed
+try:
+    from orjson import loads as json_loads  # pylint: disable=no-name-in-module
+except ImportError:
+    json_loads = json.loads
 
 
 OPENAI_API_MODEL = "gpt-4o-realtime-preview-2024-10-01"
 OPENAI_URL_FORMAT = "wss://api.openai.com/v1/realtime?model={}"
+OPENAI_PCM_RATE = 24000
+
+# frequent events, which are not logged
+STREAMED_EVENTS = ("response.audio.delta", "response.audio_transcript.delta")
+
+FIELD_VALUE = re.compile(r'\s*:\s*"')
+
+
+def get_field(smsg, key):
+    """ Returns the string value of a quoted key from a flat event, without
+    parsing the event; None if not found, or if the value is escaped """
+    pos = smsg.find(key)
+    if pos == -1:
+        return None
+    match = FIELD_VALUE.match(smsg, pos + len(key))
+    if not match:
+        return None
+    start = match.end()
+    end = smsg.find('"', start)
+    if end == -1 or smsg.find('\\', start, end) != -1:
+        return None
+    return smsg[start:end]
 
 
 class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
@@ -46,6 +77,7 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
 
     def __init__(self, call, cfg, logger=None):
         self.codec = self.choose_codec(call.sdp)
+        self.framer = self.codec.get_framer()
         self.queue = call.rtp
         self.call = call
         self.logger = logger or logging.getLogger()
@@ -55,6 +87,8 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
         self.transfer_to = None
         self.transfer_by = None
         self.tools = None
+        self.response_id = None
+        self.cancelled_response_id = None
         self.cfg = Config.get("openai", cfg)
         self.model = self.cfg.get("model", "OPENAI_API_MODEL",
                                   OPENAI_API_MODEL)
@@ -68,12 +102,39 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
         self.transfer_to = self.cfg.get("transfer_to", "OPENAI_TRANSFER_TO")
         self.transfer_by = self.cfg.get("transfer_by", "OPENAI_TRANSFER_BY", self.call.to)
         self.tools = self.cfg.get("tools", "OPENAI_TOOLS")
+        self.filler_file = self.cfg.get("filler_file", "OPENAI_FILLER_FILE")
+        self.filler_delay = int(self.cfg.get("filler_delay_ms",
+                                             "OPENAI_FILLER_DELAY_MS",
+                                             700)) / 1000
+        self.filler = ()
+        self.functions_task = None
+        self.handlers = {
+            "response.audio.delta": self.on_audio_delta,
+            "response.audio.done": self.on_audio_done,
+            "response.created": self.on_response_created,
+            "conversation.item.created": self.on_item_created,
+            "response.done": self.on_response_done,
+            "response.output_item.done": self.on_output_item_done,
+            "conversation.item.input_audio_transcription.completed":
+                self.on_speaker_transcript,
+            "response.audio_transcript.done": self.on_engine_transcript,
+            "mcp_list_tools.in_progress": self.on_mcp_list_tools,
+            "conversation.item.input_audio_transcription.failed":
+                self.on_transcription_failed,
+            "error": self.on_error,
+            "response.failed": self.on_response_failed,
+        }
 
         # normalize codec
         if self.codec.name == "mulaw":
             self.codec_name = "g711_ulaw"
         elif self.codec.name == "alaw":
             self.codec_name = "g711_alaw"
+        # optionally exchange 24kHz linear PCM with OpenAI
+        if self.cfg.get("audio_format", "OPENAI_AUDIO_FORMAT",
+                        "g711") == "pcm16":
+            self.codec_name = "pcm16"
+            self.pcm_rate = OPENAI_PCM_RATE
 
     def choose_codec(self, sdp):
         """ Returns the preferred codec from a list """
@@ -96,11 +157,13 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
                 "Authorization": f"Bearer {self.key}",
                 "OpenAI-Beta": "realtime=v1"
         }
-        self.ws = await connect(self.url, additional_headers=openai_headers)
-        self.logger.info(f"OpenAI: WebSocket connection established: {self.ws}")
-        
+        if self.filler_file:
+            self.filler = await asyncio.to_thread(load_filler,
+                                                  self.filler_file, self.codec)
         try:
-            first_message = await self.ws.recv()
+            self.ws, first_message = await ws_pool.acquire(
+                "openai", self.url, openai_headers)
+            self.logger.info(f"OpenAI: WebSocket connection established: {self.ws}")
             self.logger.info(f"OpenAI: First message received: {first_message}")
             json.loads(first_message)
         except ConnectionClosedOK:
@@ -171,11 +234,8 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
                     # Store URL and token for later use
                     if not hasattr(self, 'api_functions'):
                         self.api_functions = {}
-                    self.api_functions[func['function']['name']] = {
-                        'url': func.get('url'),
-                        'token': func.get('token'),
-                        'api_template': func.get('input_schema', {})
-                    }
+                    name = func['function']['name']
+                    self.api_functions[name] = ApiFunction(name, func)
         
         # Add API functions to tools
         if api_functions:
@@ -218,174 +278,235 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
             self.terminate_call()
 
 
-    async def handle_command(self):  # pylint: disable=too-many-branches
-        """ Handles a command from the server """
-        leftovers = b''
+    async def handle_command(self):
+        """ Handles the events from the server """
         async for smsg in self.ws:
-            msg = json.loads(smsg)
+            # audio deltas are most of the events, so they are played
+            # without building the whole event, when possible
+            etype = get_field(smsg, '"type"')
+            if etype == "response.audio.delta":
+                item_id = get_field(smsg, '"item_id"')
+                delta = get_field(smsg, '"delta"')
+                if item_id and delta is not None:
+                    self.play_audio(get_field(smsg, '"response_id"'),
+                                    item_id, delta)
+                    continue
+            elif etype == "response.audio_transcript.delta":
+                continue
+            msg = json_loads(smsg)
             t = msg["type"]
-            if t not in ["response.audio.delta", "response.audio_transcript.delta"]:
-                self.logger.info(f"Received message: {msg}")
-            if t == "response.audio.delta":
-                media = base64.b64decode(msg["delta"])
-                packets, leftovers = await self.run_in_thread(
-                    self.codec.parse, media, leftovers)
-                for packet in packets:
-                    self.queue.put_nowait(packet)
-            elif t == "response.audio.done":
-                self.logger.info(t)
-                if len(leftovers) > 0:
-                    packet = await self.run_in_thread(
-                            self.codec.parse, None, leftovers)
-                    self.queue.put_nowait(packet)
-                    leftovers = b''
-
-            elif t == "conversation.item.created":
-                if msg["item"].get('status') == "completed":
-                    self.drain_queue()
-
-            # function-calling response 
-            # https://platform.openai.com/docs/guides/realtime-conversations#function-calling
-            elif t == "response.done":
-                response = msg["response"]
-                
-                # Check for failed status
-                if response.get("status") == "failed":                    
-                    self.logger.error(f"OpenAI: Response failed: {response}")                    
-                    # Terminate call on failure
+            if t not in STREAMED_EVENTS:
+                self.logger.info("Received message: %s", msg)
+            handler = self.handlers.get(t)
+            if not handler:
+                self.logger.debug("OpenAI: Unhandled message type: %s", t)
+            elif await handler(msg):
+                return
+
+    def play_audio(self, response_id, item_id, delta):
+        """ Queues the audio of a response, unless it was cancelled """
+        if response_id == self.cancelled_response_id:
+            return
+        media = a2b_base64(delta)
+        if self.call.transcoder:
+            media = self.call.transcoder.encode(media)
+        # framing costs less than a hop to a thread
+        for packet in self.framer.feed(media):
+            self.queue.put_nowait(packet, item_id)
+
+    async def on_audio_delta(self, msg):
+        """ Plays a delta that could not be taken by the fast path """
+        self.play_audio(msg.get("response_id"), msg["item_id"], msg["delta"])
+
+    async def on_audio_done(self, msg):
+        """ Plays the last, incomplete, frame of an item """
+        self.logger.info(msg["type"])
+        packet = self.framer.flush()
+        if packet:
+            self.queue.put_nowait(packet, msg["item_id"])
+
+    async def on_response_created(self, msg):
+        """ Keeps the response being played, for barge-in """
+        self.response_id = msg["response"]["id"]
+
+    async def on_item_created(self, msg):
+        """ Stops the playback when the caller's turn is committed """
+        if msg["item"].get('status') == "completed":
+            if self.drain_queue():
+                await self.truncate()
+
+    # function-calling response
+    # https://platform.openai.com/docs/guides/realtime-conversations#function-calling
+    async def on_response_done(self, msg):
+        """ Runs the functions called in a response """
+        response = msg["response"]
+        self.response_id = None
+
+        # Check for failed status
+        if response.get("status") == "failed":
+            self.logger.error(f"OpenAI: Response failed: {response}")
+            # Terminate call on failure
+            self.terminate_call()
+            return True
+
+        api_calls = []
+        for item in response["output"]:
+            if item.get('type') == 'function_call':
+                function_name = item.get("name")
+                arguments = item.get("arguments", "{}")
+                try:
+                    params_dict = json.loads(arguments)
+                except Exception:
+                    params_dict = {}
+                if function_name == "terminate_call":
+                    self.logger.info(msg["type"])
                     self.terminate_call()
-                    return
-                
-                for item in response["output"]:
-                    if item.get('type') == 'function_call':
-                        function_name = item.get("name")
-                        arguments = item.get("arguments", "{}")
-                        try:
-                            params_dict = json.loads(arguments)
-                        except Exception:
-                            params_dict = {}
-                        function_response = None
-                        if function_name == "terminate_call":
-                            self.logger.info(t)
-                            self.terminate_call()
-                        elif function_name == "transfer_call":
-                            params = {
-                                'key': self.call.b2b_key,
-                                'method': "REFER",
-                                'body': "",
-                                'extra_headers': (
-                                    f"Refer-To: <{self.transfer_to}>\r\n"
-                                    f"Referred-By: {self.transfer_by}\r\n"
-                                )
-                            }
-                            self.call.mi_conn.execute('ua_session_update', params)
-                        elif hasattr(self, 'api_functions') and function_name in self.api_functions:
-                            function_response = await self.call_api_function(function_name, params_dict)
-
-                        if function_response:
-                            payload = {
-                                "type": "conversation.item.create",
-                                "item": {
-                                    "type": "function_call_output",
-                                    "call_id": item.get("call_id"),
-                                    "output": f"Say this to the user: {function_response}"
-                                }
-                            }
-                            await self.ws.send(json.dumps(payload))
-                            await self.ws.send(json.dumps({"type": "response.create"}))
-
-            elif t == "response.output_item.done":
-                item = msg.get("item")
-                if item and item.get("type") == "mcp_call":
-                    item_id = item.get("id")
-                    server_label = item.get("server_label")
-                    output = item.get("output")
-                    if output:
-                        # payload = {
-                        #     "type": "conversation.item.create",
-                        #     "item": {
-                        #         "type": "message",
-                        #         "role": "assistant",
-                        #         "content": [
-                        #             {"type": "text", "text": output}
-                        #         ]
-                        #     }
-                        # }
-                        # await self.ws.send(json.dumps(payload))
-                        response_payload = {
-                            "type": "response.create",
-                            "response": {
-                                "instructions": f"Report this result to the user: {output}"
-                            }
-                        }
-                        await self.ws.send(json.dumps(response_payload))
-
-            # elif t == "response.output_item.done":
-            #     item = msg.get("item")
-            #     if item and item.get("type") == "mcp_call":
-            #         item_id = item.get("id")
-            #         server_label = item.get("server_label")
-            #         print(msg)
-            #         output = item.get("output")
-            #         if output:
-            # #  mcp_tool_call not working....
-            # # TODO: add https://platform.openai.com/docs/api-reference/realtime_client_events/conversation/item/create
-            #             payload = {
-            #                 "type": "conversation.item.create",
-            #                 "item": {
-            #                     "id": item_id,
-            #                     "arguments": item.get("arguments", {}),
-            #                     "name": item.get("name"),
-            #                     "type": "mcp_tool_call",
-            #                     "output": output,
-            #                     "server_label": server_label
-            #                 }
-            #             }
-            #             await self.ws.send(json.dumps(payload))
-            #             response_payload = {
-            #                 "type": "response.create",
-            #                 "response": {
-            #                     "conversation": "auto",
-            #                     "instructions": "Be sure to voice the latest results from the MCP server"
-            #                 }
-            #             }
-            #             await self.ws.send(json.dumps(response_payload))
-
-            elif t == "conversation.item.input_audio_transcription.completed":
-                self.logger.info("Speaker: %s", msg["transcript"].rstrip())
-            elif t == "response.audio_transcript.done":
-                self.logger.info("Engine: %s", msg["transcript"])       
-            elif t == "mcp_list_tools.in_progress":
-                self.logger.info(f"OpenAI: MCP list tools in progress: {msg}")
-            elif t == "conversation.item.input_audio_transcription.failed":
-                self.logger.error(f"OpenAI: Audio transcription failed: {msg}")
-                self.terminate_call()
-            elif t == "error":
-                self.logger.error(f"OpenAI: Error message received: {msg}")
-                self.terminate_call()
-            elif t == "response.failed":
-                self.logger.error(f"OpenAI: Response failed: {msg}")
-                self.terminate_call()
-            else:
-                self.logger.debug(f"OpenAI: Unhandled message type: {t}")
+                elif function_name == "transfer_call":
+                    params = {
+                        'key': self.call.b2b_key,
+                        'method': "REFER",
+                        'body': "",
+                        'extra_headers': (
+                            f"Refer-To: <{self.transfer_to}>\r\n"
+                            f"Referred-By: {self.transfer_by}\r\n"
+                        )
+                    }
+                    self.call.mi.send('ua_session_update', params)
+                elif hasattr(self, 'api_functions') and function_name in self.api_functions:
+                    api_calls.append((item.get("call_id"),
+                                      function_name, params_dict))
+        if api_calls:
+            # run them in the background, so that the caller can
+            # still be heard (and interrupt) meanwhile
+            self.functions_task = asyncio.create_task(
+                self.run_functions(api_calls))
+        return False
+
+    async def on_output_item_done(self, msg):
+        """ Reports the result of an MCP call """
+        item = msg.get("item")
+        if item and item.get("type") == "mcp_call":
+            item_id = item.get("id")
+            server_label = item.get("server_label")
+            output = item.get("output")
+            if output:
+                # payload = {
+                #     "type": "conversation.item.create",
+                #     "item": {
+                #         "type": "message",
+                #         "role": "assistant",
+                #         "content": [
+                #             {"type": "text", "text": output}
+                #         ]
+                #     }
+                # }
+                # await self.ws.send(json.dumps(payload))
+                response_payload = {
+                    "type": "response.create",
+                    "response": {
+                        "instructions": f"Report this result to the user: {output}"
+                    }
+                }
+                await self.ws.send(json.dumps(response_payload))
+
+    # async def on_output_item_done(self, msg):
+    #     item = msg.get("item")
+    #     if item and item.get("type") == "mcp_call":
+    #         item_id = item.get("id")
+    #         server_label = item.get("server_label")
+    #         print(msg)
+    #         output = item.get("output")
+    #         if output:
+    # #  mcp_tool_call not working....
+    # # TODO: add https://platform.openai.com/docs/api-reference/realtime_client_events/conversation/item/create
+    #             payload = {
+    #                 "type": "conversation.item.create",
+    #                 "item": {
+    #                     "id": item_id,
+    #                     "arguments": item.get("arguments", {}),
+    #                     "name": item.get("name"),
+    #                     "type": "mcp_tool_call",
+    #                     "output": output,
+    #                     "server_label": server_label
+    #                 }
+    #             }
+    #             await self.ws.send(json.dumps(payload))
+    #             response_payload = {
+    #                 "type": "response.create",
+    #                 "response": {
+    #                     "conversation": "auto",
+    #                     "instructions": "Be sure to voice the latest results from the MCP server"
+    #                 }
+    #             }
+    #             await self.ws.send(json.dumps(response_payload))
+
+    async def on_speaker_transcript(self, msg):
+        """ Logs what the caller said """
+        self.logger.info("Speaker: %s", msg["transcript"].rstrip())
+
+    async def on_engine_transcript(self, msg):
+        """ Logs what the engine said """
+        self.logger.info("Engine: %s", msg["transcript"])
+
+    async def on_mcp_list_tools(self, msg):
+        """ Logs the listing of the MCP tools """
+        self.logger.info("OpenAI: MCP list tools in progress: %s", msg)
+
+    async def on_transcription_failed(self, msg):
+        """ Terminates the call when the caller cannot be transcribed """
+        self.logger.error(f"OpenAI: Audio transcription failed: {msg}")
+        self.terminate_call()
+
+    async def on_error(self, msg):
+        """ Terminates the call on errors """
+        if msg.get("error", {}).get("code") == "response_cancel_not_active":
+            # the response finished before barge-in cancelled it
+            return
+        self.logger.error(f"OpenAI: Error message received: {msg}")
+        self.terminate_call()
+
+    async def on_response_failed(self, msg):
+        """ Terminates the call when a response fails """
+        self.logger.error(f"OpenAI: Response failed: {msg}")
+        self.terminate_call()
 
     def terminate_call(self):
         """ Terminates the call """
         self.call.terminated = True
 
-    async def run_in_thread(self, func, *args):
-        """ Runs a function in a thread """
-        return await asyncio.to_thread(func, *args)
-
     def drain_queue(self):
         """ Drains the playback queue """
-        count = 0
+        self.framer.reset()
+        count = self.queue.clear()
+        if count > 0:
+            self.logger.info("dropping %d packets", count)
+        return count
+
+    async def interrupt(self):
+        """ Cancels the response being played """
+        self.framer.reset()
+        if not self.ws:
+            return
         try:
-            while self.queue.get_nowait():
-                count += 1
-        except Empty:
-            if count > 0:
-                self.logger.info("dropping %d packets", count)
+            if self.response_id:
+                self.cancelled_response_id = self.response_id
+                await self.ws.send(json.dumps({"type": "response.cancel"}))
+            await self.truncate()
+        except ConnectionClosedError as e:
+            self.logger.error(f"WebSocket connection closed: {e.code}, {e.reason}")
+
+    async def truncate(self):
+        """ Trims the interrupted item to the audio the caller heard """
+        item_id, audio_end_ms = self.queue.cut_position()
+        if not item_id:
+            return
+        self.logger.info("truncating %s at %d ms", item_id, audio_end_ms)
+        await self.ws.send(json.dumps({
+            "type": "conversation.item.truncate",
+            "item_id": item_id,
+            "content_index": 0,
+            "audio_end_ms": audio_end_ms,
+        }))
 
     async def send(self, audio):
         """ Sends audio to OpenAI """
@@ -408,21 +529,55 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
             self.terminate_call()
 
     async def close(self):
-        await self.ws.close()
+        if self.functions_task:
+            self.functions_task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+    async def run_functions(self, api_calls):
+        """ Runs the API functions requested in a response concurrently and
+        sends all their outputs back in a single response """
+        filler = None
+        if self.filler:
+            filler = asyncio.get_running_loop().call_later(
+                self.filler_delay, self.play_filler)
+        try:
+            results = await asyncio.gather(
+                *[self.call_api_function(name, params)
+                  for _, name, params in api_calls])
+        finally:
+            if filler:
+                filler.cancel()
+        try:
+            sent = False
+            for (call_id, _, _), result in zip(api_calls, results):
+                if not result:
+                    continue
+                await self.ws.send(json.dumps({
+                    "type": "conversation.item.create",
+                    "item": {
+                        "type": "function_call_output",
+                        "call_id": call_id,
+                        "output": f"Say this to the user: {result}"
+                    }
+                }))
+                sent = True
+            if sent:
+                await self.ws.send(json.dumps({"type": "response.create"}))
+        except ConnectionClosedError as e:
+            self.logger.error(f"WebSocket connection closed: {e.code}, {e.reason}")
+
+    def play_filler(self):
+        """ Plays the filler prompt, unless something is already playing """
+        if not self.queue.empty():
+            return
+        self.logger.info("playing filler prompt")
+        for frame in self.filler:
+            self.queue.put_nowait(frame)
 
     async def call_api_function(self, function_name, params):
         """Calls external API function"""
         try:
-            func_config = self.api_functions[function_name]
-            url = func_config['url']
-            token = func_config.get('token')
-            template = func_config.get('api_template', {})
-            
-            headers = {'Content-Type': 'application/json'}
-            if token:
-                headers['Authorization'] = f'Bearer {token}'
-            
-            # Prepare variables for template
             variables = {
                 'function_name': function_name,
                 'parameters': params,
@@ -430,49 +585,17 @@ class OpenAI(AIEngine):  # pylint: disable=too-many-instance-attributes
                 'bot_id': getattr(self.call, 'bot_id', 'unknown'),
                 'call_id': self.call.b2b_key
             }
-            
-            # Add function_name to parameters for template substitution
+            # parameters can be used directly in the template as well
             if isinstance(params, dict):
                 params['function_name'] = function_name
-            
-            # Apply template with variable substitution
-            self.logger.info(f"Template: {template}")
-            self.logger.info(f"Variables: {variables}")
-            payload = self.apply_template(template, variables)
-            self.logger.info(f"Final payload: {payload}")
-            
-            response = requests.post(url, json=payload, headers=headers)
-            print(response.json())
-            response.raise_for_status()
-            
-            result = response.json()
-            self.logger.info(f"API function {function_name} called successfully: {result}")
+                variables.update(params)
+            result = await self.api_functions[function_name].call(variables)
+            self.logger.info("API function %s called successfully: %s",
+                             function_name, result)
             return str(result)
-            
+
         except Exception as e:
             self.logger.error(f"Error calling API function {function_name}: {e}")
             return f"Error: {str(e)}"
 
-    def apply_template(self, template, variables):
-        """Apply template with variable substitution"""
-        import json
-        import re
-        
-        # Convert template to string for replacement
-        template_str = json.dumps(template)
-        
-        # Create combined variables dict
-        all_vars = variables.copy()
-        if 'parameters' in variables and isinstance(variables['parameters'], dict):
-            all_vars.update(variables['parameters'])
-        
-        # Replace any variables in format {variable_name}
-        for var_name, var_value in all_vars.items():
-            placeholder = f"{{{var_name}}}"
-            if isinstance(var_value, dict):
-                var_value = json.dumps(var_value)
-            template_str = template_str.replace(placeholder, str(var_value))
-        
-        return json.loads(template_str)
-
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -22,87 +22,136 @@
 
 """ Module that decodes OGG Opus pages """
 
+import zlib
+import logging
 
-class OggPageException(Exception):
-    """ Opus parsing exception """
-
+OGG_CAPTURE = b'OggS'
+OGG_HEADER_LEN = 27
 
-class OggOpusPage:
+# Ogg uses the CRC32 polynomial of zlib, but most significant bit first,
+# with no initial or final inversion: it is computed by zlib over the
+# data with the bits of each byte reversed, and the result reversed back
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
 
-    """ Opus Page """
 
-    def __init__(self, payload):
-        self.header = payload[:27]
-        self.sequence_number = int.from_bytes(self.header[18:22], 'little')
-        self.page_segments = self.header[26]
-        header_len = 27 + self.page_segments
-        self.segments_lens = payload[27:header_len]
-        segments_len = sum(self.segments_lens)
-        page_len = header_len + segments_len
-        self.page = payload[0:page_len]
-        self.segments_payload = self.page[header_len:]
-        self.segments = []
+def _reverse32(value):
+    """ Reverses the bits of a 32 bits integer """
+    return int.from_bytes(value.to_bytes(4, 'little').translate(
+        _REVERSED_BITS), 'big')
 
-        if self.sequence_number == 0 and \
-                self.segments_payload.startswith(b'OpusHead'):
-            return
-        if self.sequence_number == 1 and \
-                self.segments_payload.startswith(b'OpusTags'):
-            return
 
-        for i in range(self.page_segments):
-            segment_len = self.segments_lens[i]
-            segment = self.segments_payload[0:segment_len]
-            self.segments_payload = self.segments_payload[segment_len:]
-            self.segments.append(segment)
+def ogg_page_crc(page):
+    """ Computes the CRC of an Ogg page, with the checksum field zeroed """
+    data = memoryview(bytes(page).translate(_REVERSED_BITS))
+    crc = zlib.crc32(data[:22], 0xFFFFFFFF)
+    crc = zlib.crc32(b'\x00\x00\x00\x00', crc)
+    crc = zlib.crc32(data[26:], crc)
+    return _reverse32(crc ^ 0xFFFFFFFF)
 
-    def size(self):
-        """ returns the size of an Opus Page """
-        return len(self.page)
 
-    def __str__(self):
-        return f"OpusOggPage({self.size()})"
+class OggPageException(Exception):
+    """ Opus parsing exception """
 
 
 class OggOpus:
 
-    """ Opus Packet """
-
-    def __init__(self, payload):
-        self.payload = payload
-        self.last_packet = None
-        self.pages = []
-        self.discarded = []
-        self.parse()
+    """ Streaming Ogg Opus demuxer
+
+    Chunks of any size are fed to the demuxer, which returns the Opus
+    packets completed so far. Pages split across chunks are buffered until
+    they are complete, packets spanning multiple segments or pages (lacing
+    values of 255) are reassembled, and pages failing the CRC check are
+    discarded.
+    """
+
+    def __init__(self, payload=None, check_crc=True):
+        self.check_crc = check_crc
+        self.buffer = bytearray()
+        self.offset = 0
+        self.partial = bytearray()
+        self.stream_packets = 0
+        self.pages = 0
+        self.discarded = 0
+        self.crc_errors = 0
+        self.completed = []
+        if payload:
+            self.completed = self.feed(payload)
+
+    def feed(self, data):
+        """ Adds a chunk of the stream and returns the completed packets """
+        if self.offset:
+            # only keep the unparsed tail
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+        packets = []
+        view = memoryview(self.buffer)
+        try:
+            while self.parse_page(view, packets):
+                pass
+        finally:
+            view.release()
+        return packets
 
-    def parse_page(self):
-        """ parses an Opus Page """
-        if not self.payload.startswith(b'OggS'):
-            # search first occurance of header
-            n = self.payload.find(b'OggS')
+    def parse_page(self, view, packets):
+        """ Parses the page at the current offset, if complete """
+        offset = self.offset
+        available = len(view) - offset
+        if available < OGG_HEADER_LEN:
+            return False
+        if view[offset:offset + 4] != OGG_CAPTURE:
+            # resynchronize on the next capture pattern
+            n = self.buffer.find(OGG_CAPTURE, offset + 1)
             if n < 0:
-                # no page found
-                n = len(self.payload)
-                self.discarded.append(self.payload)
-                self.payload = ""
-                return
-            self.discarded.append(self.payload[0:n])
-            self.payload = self.payload[n:]
-
-        page = OggOpusPage(self.payload)
-        self.payload = self.payload[page.size():]
-        self.pages.append(page)
-
-    def parse(self):
-        """ parses the packet payload """
-        while len(self.payload) > 0:
-            self.parse_page()
+                # keep a possible partial capture pattern
+                n = max(offset, len(view) - 3)
+            self.discarded += n - offset
+            self.offset = n
+            return n != offset
+        page_segments = view[offset + 26]
+        header_len = OGG_HEADER_LEN + page_segments
+        if available < header_len:
+            return False
+        lacing = view[offset + OGG_HEADER_LEN:offset + header_len]
+        page_len = header_len + sum(lacing)
+        if available < page_len:
+            return False
+        self.offset = offset + page_len
+
+        page = view[offset:offset + page_len]
+        if self.check_crc:
+            crc = int.from_bytes(page[22:26], 'little')
+            if ogg_page_crc(page) != crc:
+                self.crc_errors += 1
+                self.partial.clear()
+                logging.warning("discarding Ogg page with invalid CRC")
+                return True
+        self.pages += 1
+
+        flags = page[5]
+        if flags & 0x02:
+            # beginning of a new logical stream
+            self.stream_packets = 0
+        if not flags & 0x01:
+            self.partial.clear()
+        pos = header_len
+        for segment_len in lacing:
+            self.partial += page[pos:pos + segment_len]
+            pos += segment_len
+            if segment_len == 255:
+                # packet continues in the next segment
+                continue
+            packet = bytes(self.partial)
+            self.partial.clear()
+            self.stream_packets += 1
+            if self.stream_packets <= 2 and \
+                    packet.startswith((b'OpusHead', b'OpusTags')):
+                continue
+            packets.append(packet)
+        return True
 
     def packets(self):
-        """ returns all the packets within all segments """
-        packets = []
-        for page in self.pages:
-            packets += page.segments
-        return packets
+        """ returns the packets parsed from the initial payload """
+        return self.completed
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
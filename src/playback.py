@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Audio queued to be played to the caller """
+
+from collections import deque
+
+
+class PlaybackBuffer:
+    """ Queue of the frames to be played, tagged with the item they belong to
+
+    The engine tags each frame with the identifier of the response item it
+    belongs to; the buffer keeps the offset of each frame within its item,
+    so that the exact amount of audio played from an item is known, even
+    when the playback is cut. Everything runs on the event loop, so no
+    locking is needed.
+    """
+
+    def __init__(self, ptime=20):
+        self.ptime = ptime
+        self.frames = deque()
+        self.queued_item_id = None
+        self.queued_ms = 0
+        self.cut_item_id = None
+        self.cut_ms = 0
+
+    def put_nowait(self, payload, item_id=None):
+        """ Queues a frame of an item """
+        if item_id != self.queued_item_id:
+            self.queued_item_id = item_id
+            self.queued_ms = 0
+        self.frames.append((payload, item_id, self.queued_ms))
+        self.queued_ms += self.ptime
+
+    def pop(self):
+        """ Returns the next frame to be played, or None """
+        if not self.frames:
+            return None
+        return self.frames.popleft()[0]
+
+    def clear(self):
+        """ Drops all the queued frames and returns their number """
+        count = len(self.frames)
+        if count:
+            _, self.cut_item_id, self.cut_ms = self.frames[0]
+        self.frames.clear()
+        return count
+
+    def cut_position(self):
+        """ Returns the item whose playback was last cut by clear() and the
+        ms of it that were played """
+        return self.cut_item_id, self.cut_ms
+
+    def empty(self):
+        """ Indicates whether there is nothing left to play """
+        return not self.frames
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
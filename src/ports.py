@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Allocates the RTP ports used by calls """
+
+import time
+import secrets
+from array import array
+from collections import deque
+
+
+class NoAvailablePorts(Exception):
+    """ There are no available ports """
+
+
+class PortAllocator():
+    """ Hands out random ports from a range in constant time
+
+    Free ports are kept in an array and allocated by swapping a random entry
+    with the last one. Released ports are quarantined for a while, so that
+    late packets of an old call do not reach a new call.
+    """
+
+    def __init__(self, min_port, max_port, quarantine=0):
+        self.min_port = min_port
+        self.max_port = max_port
+        self.quarantine = quarantine
+        self.free = array('H', range(min_port, max_port))
+        self.quarantined = deque()
+        self.allocations = 0
+        self.exhausted = 0
+
+    def set_range(self, min_port, max_port):
+        """ Restricts the pool to a new range of ports """
+        self.min_port = min_port
+        self.max_port = max_port
+        self.free = array('H', range(min_port, max_port))
+        self.quarantined.clear()
+
+    def _release_quarantined(self):
+        now = time.monotonic()
+        while self.quarantined and self.quarantined[0][0] <= now:
+            self.free.append(self.quarantined.popleft()[1])
+
+    def allocate(self):
+        """ Returns a random free port """
+        self._release_quarantined()
+        if not self.free:
+            self.exhausted += 1
+            raise NoAvailablePorts()
+        index = secrets.randbelow(len(self.free))
+        port = self.free[index]
+        self.free[index] = self.free[-1]
+        self.free.pop()
+        self.allocations += 1
+        return port
+
+    def release(self, port):
+        """ Returns a port to the pool, after the quarantine expires """
+        if self.quarantine > 0:
+            self.quarantined.append((time.monotonic() + self.quarantine,
+                                     port))
+        else:
+            self.free.append(port)
+
+    def stats(self):
+        """ Returns the pool utilization """
+        self._release_quarantined()
+        size = self.max_port - self.min_port
+        free = len(self.free)
+        quarantined = len(self.quarantined)
+        in_use = size - free - quarantined
+        return {"size": size,
+                "in_use": in_use,
+                "free": free,
+                "quarantined": quarantined,
+                "utilization": round(in_use / size, 4) if size else 0,
+                "allocations": self.allocations,
+                "exhausted": self.exhausted}
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
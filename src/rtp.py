@@ -17,63 +17,120 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-# Grabbed from https://gitlab.com/nickvsnetworking/pyrtp
-
 """ Encodes and decodes RTP packets """
 
+import struct
 
-def decode_rtp_packet(packet_bytes):
-    """ Decodes a RTP packet """
-    packet_vars = {}
-    byte1 = packet_bytes[0:2]
-    byte1 = int(byte1, 16)
-    byte1 = format(byte1, 'b')
-    packet_vars['version'] = int(byte1[0:2], 2)
-    packet_vars['padding'] = int(byte1[2:3])
-    packet_vars['extension'] = int(byte1[3:4])
-    packet_vars['csi_count'] = int(byte1[4:8], 2)
-
-    byte2 = packet_bytes[2:4]
+RTP_VERSION = 2
+RTP_HEADER_LEN = 12
 
-    byte2 = int(byte2, 16)
-    byte2 = format(byte2, 'b').zfill(8)
-    packet_vars['marker'] = int(byte2[0:1])
-    packet_vars['payload_type'] = int(byte2[1:8], 2)
+_HEADER = struct.Struct("!BBHII")
+_EXTENSION = struct.Struct("!HH")
+_SEQ_TS = struct.Struct("!HI")
 
-    packet_vars['sequence_number'] = int(str(packet_bytes[4:8]), 16)
 
-    packet_vars['timestamp'] = int(str(packet_bytes[8:16]), 16)
+class RtpPacketError(ValueError):
+    """ Raised when a RTP packet cannot be decoded """
 
-    packet_vars['ssrc'] = int(str(packet_bytes[16:24]), 16)
 
-    packet_vars['payload'] = str(packet_bytes[24:])
-    return packet_vars
+def decode_rtp_packet(packet_bytes):
+    """ Decodes a RTP packet
+
+    The payload is returned as a memoryview over the original buffer, with
+    the CSRC list, the header extension and the padding stripped.
+    """
+    data = memoryview(packet_bytes)
+    length = len(data)
+    if length < RTP_HEADER_LEN:
+        raise RtpPacketError(f"packet too short ({length} bytes)")
+
+    byte1, byte2, sequence_number, timestamp, ssrc = \
+        _HEADER.unpack_from(data)
+    version = byte1 >> 6
+    if version != RTP_VERSION:
+        raise RtpPacketError(f"unsupported RTP version {version}")
+    padding = (byte1 >> 5) & 0x01
+    extension = (byte1 >> 4) & 0x01
+    csi_count = byte1 & 0x0F
+
+    offset = RTP_HEADER_LEN + 4 * csi_count
+    csrcs = [int.from_bytes(data[i:i + 4], 'big')
+             for i in range(RTP_HEADER_LEN, offset, 4)]
+    if extension:
+        if length < offset + 4:
+            raise RtpPacketError("truncated header extension")
+        _, ext_len = _EXTENSION.unpack_from(data, offset)
+        offset += 4 + 4 * ext_len
+
+    end = length
+    if padding:
+        end -= data[length - 1]
+    if end < offset:
+        raise RtpPacketError("invalid header or padding length")
+
+    return {
+        'version': version,
+        'padding': padding,
+        'extension': extension,
+        'csi_count': csi_count,
+        'csrcs': csrcs,
+        'marker': byte2 >> 7,
+        'payload_type': byte2 & 0x7F,
+        'sequence_number': sequence_number,
+        'timestamp': timestamp,
+        'ssrc': ssrc,
+        'payload': data[offset:end],
+    }
 
 
 def generate_rtp_packet(packet_vars):
     """ Encodes/Generates a RTP packet """
-    version = str(format(packet_vars['version'], 'b').zfill(2))
-    padding = str(packet_vars['padding'])
-    extension = str(packet_vars['extension'])
-    csi_count = str(format(packet_vars['csi_count'], 'b').zfill(4))
-    byte1_body = int((version + padding + extension + csi_count), 2)
-    byte1 = format(byte1_body, 'x').zfill(2)
-
-    # Generate second byte of header as binary string:
-    marker = str(packet_vars['marker'])
-    payload_type = str(format(packet_vars['payload_type'], 'b').zfill(7))
-    byte2 = format(int((marker + payload_type), 2), 'x').zfill(2)
-
-    sequence_number = format(packet_vars['sequence_number'], 'x').zfill(4)
-
-    timestamp = format(packet_vars['timestamp'], 'x').zfill(8)
-
-    ssrc = str(format(packet_vars['ssrc'], 'x').zfill(8))
-
-    payload = packet_vars['payload']
-
-    packet = byte1 + byte2 + sequence_number + timestamp + ssrc + payload
-
-    return packet
+    byte1 = (packet_vars['version'] << 6) | \
+        (packet_vars['padding'] << 5) | \
+        (packet_vars['extension'] << 4) | \
+        packet_vars['csi_count']
+    byte2 = (packet_vars['marker'] << 7) | packet_vars['payload_type']
+    header = _HEADER.pack(byte1, byte2,
+                          packet_vars['sequence_number'] & 0xFFFF,
+                          packet_vars['timestamp'] & 0xFFFFFFFF,
+                          packet_vars['ssrc'] & 0xFFFFFFFF)
+    return header + bytes(packet_vars['payload'])
+
+
+class RtpStream:
+    """ Builds the outbound packets of a single RTP stream
+
+    The header is packed once and only the sequence number and timestamp
+    are patched for every packet. Both wrap around as mandated by RFC 3550.
+    """
+
+    def __init__(self, payload_type, ssrc, sequence_number=0, timestamp=0):
+        self.payload_type = payload_type
+        self.ssrc = ssrc & 0xFFFFFFFF
+        self.sequence_number = sequence_number & 0xFFFF
+        self.timestamp = timestamp & 0xFFFFFFFF
+        self.marker = True
+        self.header = bytearray(_HEADER.pack(RTP_VERSION << 6,
+                                             payload_type & 0x7F,
+                                             self.sequence_number,
+                                             self.timestamp,
+                                             self.ssrc))
+
+    def build(self, payload):
+        """ Builds the next packet carrying payload """
+        header = self.header
+        if self.marker:
+            header[1] |= 0x80
+        _SEQ_TS.pack_into(header, 2, self.sequence_number, self.timestamp)
+        packet = header + payload
+        if self.marker:
+            header[1] &= 0x7F
+            self.marker = False
+        self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        return packet
+
+    def skip(self, ts_increment):
+        """ Advances the timestamp without sending a packet """
+        self.timestamp = (self.timestamp + ts_increment) & 0xFFFFFFFF
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
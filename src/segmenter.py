@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Splits streamed text into sentences, to be synthesized one by one """
+
+import re
+
+# a sentence, or clause, ends with punctuation followed by a space; the
+# space may only arrive with the next chunk, e.g. for "3." and "5"
+BOUNDARY = re.compile(r'[.!?;:]+["\')\]]*\s+|,\s+|\n+')
+# a period that does not end a sentence
+ABBREVIATION = re.compile(
+    r'(?:^|\s)(?:[A-Z]|Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|e\.g|i\.e)\.$')
+# clauses shorter than this are not split at commas
+CLAUSE_LEN = 50
+
+
+class SentenceSegmenter:
+    """ Accumulates chunks of text and returns the complete sentences
+
+    Long sentences are also split at their commas, so that the first words
+    of an answer can be spoken sooner.
+    """
+
+    def __init__(self, clause_len=CLAUSE_LEN):
+        self.clause_len = clause_len
+        self.pending = ""
+
+    def feed(self, text):
+        """ Adds text and returns the sentences it completed """
+        self.pending += text
+        segments = []
+        start = 0
+        for match in BOUNDARY.finditer(self.pending):
+            segment = self.pending[start:match.end()].strip()
+            if match.group().startswith(","):
+                if len(segment) < self.clause_len:
+                    continue
+            elif ABBREVIATION.search(segment):
+                continue
+            if segment:
+                segments.append(segment)
+            start = match.end()
+        self.pending = self.pending[start:]
+        return segments
+
+    def flush(self):
+        """ Returns the text left, if any """
+        segment = self.pending.strip()
+        self.pending = ""
+        return segment or None
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
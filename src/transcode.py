@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Transcodes G.711 audio to and from linear PCM16 """
+
+from math import gcd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+G711_RATE = 8000
+
+
+def _ulaw_decode_table():
+    u = ~np.arange(256, dtype=np.int32) & 0xFF
+    t = (((u & 0x0F) << 3) + 0x84) << ((u & 0x70) >> 4)
+    return np.where(u & 0x80, 0x84 - t, t - 0x84).astype(np.int16)
+
+
+def _alaw_decode_table():
+    a = np.arange(256, dtype=np.int32) ^ 0x55
+    seg = (a & 0x70) >> 4
+    t = (a & 0x0F) << 4
+    t = np.where(seg == 0, t + 8, (t + 0x108) << np.maximum(seg - 1, 0))
+    return np.where(a & 0x80, t, -t).astype(np.int16)
+
+
+def _ulaw_encode_table():
+    # indexed by the 16 bit sample, viewed as unsigned
+    pcm = np.arange(65536, dtype=np.int32).astype(np.uint16).view(np.int16)
+    val = pcm.astype(np.int32) >> 2
+    mask = np.where(val < 0, 0x7F, 0xFF)
+    val = np.minimum(np.abs(val), 8159) + 0x21
+    seg = np.searchsorted([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF,
+                           0xFFF, 0x1FFF], val)
+    uval = (np.minimum(seg, 7) << 4) | \
+        ((val >> (np.minimum(seg, 7) + 1)) & 0x0F)
+    uval = np.where(seg >= 8, 0x7F, uval)
+    return ((uval ^ mask) & 0xFF).astype(np.uint8)
+
+
+def _alaw_encode_table():
+    pcm = np.arange(65536, dtype=np.int32).astype(np.uint16).view(np.int16)
+    val = pcm.astype(np.int32) >> 3
+    mask = np.where(val >= 0, 0xD5, 0x55)
+    val = np.where(val >= 0, val, -val - 1)
+    seg = np.searchsorted([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF,
+                           0x7FF, 0xFFF], val)
+    aval = (np.minimum(seg, 7) << 4) | \
+        ((val >> np.where(seg < 2, 1, np.minimum(seg, 7))) & 0x0F)
+    aval = np.where(seg >= 8, 0x7F, aval)
+    return ((aval ^ mask) & 0xFF).astype(np.uint8)
+
+
+DECODE_TABLES = {
+    "mulaw": _ulaw_decode_table(),
+    "alaw": _alaw_decode_table(),
+}
+
+ENCODE_TABLES = {
+    "mulaw": _ulaw_encode_table(),
+    "alaw": _alaw_encode_table(),
+}
+
+
+class Resampler:
+    """ Streaming polyphase resampler for rational rate ratios
+
+    The state between calls is kept, so consecutive chunks of a stream can
+    be resampled without discontinuities.
+    """
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=16):
+        g = gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps_per_phase
+        n = taps_per_phase * self.up
+        cutoff = 1.0 / max(self.up, self.down)
+        t = np.arange(n) - (n - 1) / 2
+        h = np.sinc(cutoff * t) * np.kaiser(n, 8.0)
+        h *= self.up / h.sum()
+        # phases[p][j] multiplies x[q - taps + 1 + j]
+        self.phases = np.ascontiguousarray(
+            h.reshape(taps_per_phase, self.up).T[:, ::-1], dtype=np.float32)
+        self.history = np.zeros(taps_per_phase - 1, dtype=np.float32)
+        self.position = (taps_per_phase - 1) * self.up
+
+    def process(self, samples):
+        """ Resamples a chunk of samples """
+        buf = np.concatenate((self.history, samples.astype(np.float32)))
+        # windows[i] is a view of x[i .. i + taps - 1], nothing is copied
+        windows = sliding_window_view(buf, self.taps)
+        last = len(buf) * self.up - 1
+        count = max(0, (last - self.position) // self.down + 1)
+        if self.down == 1:
+            # every input yields one output per phase, starting at phase 0
+            out = (windows @ self.phases.T).ravel()
+        else:
+            # outputs r, r + up, ... share a phase and their windows are
+            # down samples apart
+            out = np.empty(count, dtype=np.float32)
+            for r in range(min(self.up, count)):
+                m = self.position + r * self.down
+                start = m // self.up - self.taps + 1
+                stop = start + len(range(r, count, self.up)) * self.down
+                out[r::self.up] = windows[start:stop:self.down] @ \
+                    self.phases[m % self.up]
+        consumed = len(buf) - (self.taps - 1)
+        self.history = buf[consumed:]
+        self.position += count * self.down - consumed * self.up
+        return out
+
+class Transcoder:
+    """ Converts a call's G.711 audio to and from PCM16 at another rate """
+
+    def __init__(self, codec_name, pcm_rate):
+        self.pcm_rate = pcm_rate
+        self.pending = b''
+        self.decode_table = DECODE_TABLES[codec_name]
+        self.encode_table = ENCODE_TABLES[codec_name]
+        if pcm_rate != G711_RATE:
+            self.upsampler = Resampler(G711_RATE, pcm_rate)
+            self.downsampler = Resampler(pcm_rate, G711_RATE)
+        else:
+            self.upsampler = self.downsampler = None
+
+    @staticmethod
+    def supports(codec_name):
+        """ Indicates whether a codec can be transcoded """
+        return codec_name in DECODE_TABLES
+
+    def decode(self, payload):
+        """ Converts G.711 payload to PCM16 (little endian) bytes """
+        samples = self.decode_table[np.frombuffer(payload, dtype=np.uint8)]
+        if self.upsampler:
+            samples = np.clip(np.rint(self.upsampler.process(samples)),
+                              -32768, 32767)
+        return samples.astype('<i2').tobytes()
+
+    def encode(self, pcm):
+        """ Converts PCM16 (little endian) bytes to G.711 payload """
+        if self.pending:
+            pcm = self.pending + pcm
+        # keep an odd trailing byte for the next chunk
+        self.pending = pcm[len(pcm) & ~1:]
+        samples = np.frombuffer(pcm, dtype='<i2', count=len(pcm) // 2)
+        if self.downsampler:
+            samples = np.clip(np.rint(self.downsampler.process(samples)),
+                              -32768, 32767).astype(np.int16)
+        return self.encode_table[samples.view(np.uint16)].tobytes()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
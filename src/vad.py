@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Energy based voice activity detection on G.711 audio """
+
+import math
+from collections import deque
+import numpy as np
+
+import metrics
+from transcode import DECODE_TABLES
+
+# squared amplitude of each G.711 byte, normalized to full scale
+ENERGY_TABLES = {name: (table.astype(np.float64) / 32768) ** 2
+                 for name, table in DECODE_TABLES.items()}
+
+_stats = {"frames": 0, "forwarded": 0, "barge_ins": 0}
+metrics.register("vad", lambda: dict(_stats))
+
+
+def frame_energy(table, frame):
+    """ Returns the energy of a G.711 frame, in dBFS """
+    energy = table[np.frombuffer(frame, dtype=np.uint8)].mean()
+    if energy <= 0:
+        return -100.0
+    return 10 * math.log10(energy)
+
+
+class VoiceActivityDetector():  # pylint: disable=too-many-instance-attributes
+    """ Gates the inbound audio of a call to the frames containing speech
+
+    Frames preceding the speech onset (pre-roll) and following its end
+    (hangover) are forwarded as well, so that utterances are not clipped.
+    During silence, a frame is still let through every keepalive interval.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, codec_name, ptime, threshold,
+                 hangover_ms, preroll_ms, keepalive_ms):
+        self.table = ENERGY_TABLES[codec_name]
+        self.threshold = threshold
+        self.hangover = hangover_ms // ptime
+        self.keepalive = keepalive_ms // ptime
+        self.preroll = deque(maxlen=max(1, preroll_ms // ptime))
+        self.remaining = 0
+        self.silent = 0
+        self.active = False
+
+    def is_speech(self, frame):
+        """ Indicates whether a frame contains speech """
+        return frame_energy(self.table, frame) >= self.threshold
+
+    def process(self, frame):
+        """ Returns the frames that should be forwarded """
+        _stats["frames"] += 1
+        if self.is_speech(frame):
+            self.active = True
+            self.remaining = self.hangover
+            self.silent = 0
+            frames = list(self.preroll)
+            self.preroll.clear()
+            frames.append(frame)
+        elif self.remaining > 0:
+            self.remaining -= 1
+            frames = [frame]
+        else:
+            self.active = False
+            self.silent += 1
+            if self.keepalive and self.silent % self.keepalive == 0:
+                frames = [frame]
+            else:
+                self.preroll.append(frame)
+                frames = []
+        _stats["forwarded"] += len(frames)
+        return frames
+
+
+class BargeInDetector():
+    """ Detects the caller talking over the audio played by the engine
+
+    An onset is reported after enough consecutive frames above the
+    threshold. To avoid reacting to the echo of the engine's own voice, the
+    inbound frames must also be louder than the recently played audio
+    attenuated by the expected echo return loss.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, codec_name, ptime, threshold, min_speech_ms,
+                 echo_loss):
+        self.table = ENERGY_TABLES[codec_name]
+        self.threshold = threshold
+        self.min_frames = max(1, min_speech_ms // ptime)
+        self.echo_loss = echo_loss
+        # the played level decays with 1dB per frame
+        self.played_level = -100.0
+        self.frames = 0
+
+    def played(self, frame):
+        """ Accounts a frame played to the caller """
+        self.played_level = max(frame_energy(self.table, frame),
+                                self.played_level - 1)
+
+    def idle(self):
+        """ Accounts a tick where nothing was played """
+        self.played_level = max(self.played_level - 1, -100.0)
+
+    def process(self, frame, playing):
+        """ Returns True when the caller starts talking over playback """
+        if not playing:
+            self.frames = 0
+            return False
+        energy = frame_energy(self.table, frame)
+        if energy < self.threshold or \
+                (self.echo_loss and
+                 energy < self.played_level - self.echo_loss):
+            self.frames = 0
+            return False
+        self.frames += 1
+        if self.frames != self.min_frames:
+            return False
+        _stats["barge_ins"] += 1
+        return True
+
+
+def get_vad(flavor, cfg, codec):
+    """ Returns the VAD of a call, if enabled for the flavor/bot """
+    if not cfg.getboolean("vad", f"{flavor.upper()}_VAD", False):
+        return None
+    if codec.name not in ENERGY_TABLES:
+        return None
+    prefix = f"{flavor.upper()}_VAD"
+    return VoiceActivityDetector(
+        codec.name, codec.ptime,
+        float(cfg.get("vad_threshold", f"{prefix}_THRESHOLD", -45)),
+        int(cfg.get("vad_hangover_ms", f"{prefix}_HANGOVER_MS", 600)),
+        int(cfg.get("vad_preroll_ms", f"{prefix}_PREROLL_MS", 200)),
+        int(cfg.get("vad_keepalive_ms", f"{prefix}_KEEPALIVE_MS", 1000)))
+
+
+def get_barge_in(flavor, cfg, codec):
+    """ Returns the barge-in detector of a call, if enabled """
+    prefix = f"{flavor.upper()}_BARGE_IN"
+    if not cfg.getboolean("barge_in", prefix, False):
+        return None
+    if codec.name not in ENERGY_TABLES:
+        return None
+    return BargeInDetector(
+        codec.name, codec.ptime,
+        float(cfg.get("barge_in_threshold", f"{prefix}_THRESHOLD", -35)),
+        int(cfg.get("barge_in_min_ms", f"{prefix}_MIN_MS", 100)),
+        float(cfg.get("barge_in_echo_loss", f"{prefix}_ECHO_LOSS", 15)))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
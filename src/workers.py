@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Multi-process mode: a supervisor receives the OpenSIPS events and shards the
+calls to worker processes, each running its own engine loop
+"""
+
+import json
+import time
+import zlib
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing
+from logging.handlers import QueueListener
+from collections import deque
+
+from opensips.mi import OpenSIPSMIException
+from opensips.event import OpenSIPSEventHandler, OpenSIPSEventException
+
+import call
+import engine
+import metrics
+import log_writer
+from config import Config
+
+HEARTBEAT_INTERVAL = 5
+RESTART_DELAY = 1
+# events kept for a worker that is (re)starting
+MAX_PENDING_EVENTS = 1000
+
+
+def port_range(index, count):
+    """ Returns the RTP ports range owned by a worker """
+    size = (call.max_rtp_port - call.min_rtp_port) // count
+    start = call.min_rtp_port + index * size
+    end = call.max_rtp_port if index == count - 1 else start + size
+    return start, end
+
+
+def worker_main(index, count, conn, log_queue):
+    """ Entry point of a worker process """
+    # only the supervisor writes the application log, so that the workers
+    # do not rotate the same file
+    logging.getLogger().addHandler(
+        log_writer.get_handler(log_writer.ProcessQueueHandler(log_queue)))
+    try:
+        asyncio.run(async_worker(index, count, conn))
+    finally:
+        # a worker exits without running the atexit handlers
+        log_writer.stop()
+
+
+async def async_worker(index, count, conn):
+    """ Runs the engine of a worker, fed with events by the supervisor """
+    engine.main_task = asyncio.current_task()
+    min_port, max_port = port_range(index, count)
+    call.available_ports.set_range(min_port, max_port)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(False)
+
+    def read_event():
+        try:
+            data = sock.recv(65535)
+        except BlockingIOError:
+            return
+        engine.udp_handler(json.loads(data))
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(sock.fileno(), read_event)
+    loop.add_signal_handler(
+        signal.SIGTERM,
+        lambda: asyncio.create_task(engine.shutdown(signal.SIGTERM,
+                                                    loop, None)))
+    # Ctrl+C reaches the whole process group; the supervisor handles it
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+
+    logging.info("worker %d handling RTP ports %d-%d",
+                 index, min_port, max_port)
+    conn.send(("ready", sock.getsockname()[1]))
+    try:
+        while True:
+            conn.send(("stats", {"calls": len(engine.calls),
+                                 **metrics.snapshot()}))
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+    except asyncio.CancelledError:
+        pass
+
+
+class Worker():
+    """ A worker process, as seen by the supervisor """
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.port = None
+        self.stats = {}
+        self.last_seen = None
+        self.restarts = 0
+        self.pending = deque()
+
+
+class Supervisor():
+    """ Forks the workers and dispatches the events to them """
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = [Worker(i) for i in range(count)]
+        self.context = multiprocessing.get_context("spawn")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stopping = False
+        self.dropped = 0
+        self.loop = None
+        self.done = None
+        # the records logged by the workers
+        self.log_queue = self.context.Queue()
+        self.log_listener = None
+
+    def start_worker(self, worker):
+        """ Starts (or restarts) the process of a worker """
+        parent_conn, child_conn = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(worker.index, self.count, child_conn, self.log_queue),
+            name=f"worker-{worker.index}", daemon=True)
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.port = None
+        self.loop.add_reader(parent_conn.fileno(), self.read_worker, worker)
+        self.loop.add_reader(worker.process.sentinel, self.worker_exited,
+                             worker)
+        logging.info("started worker %d (pid %d)",
+                     worker.index, worker.process.pid)
+
+    def read_worker(self, worker):
+        """ Handles a message received from a worker """
+        try:
+            kind, data = worker.conn.recv()
+        except (EOFError, OSError):
+            self.loop.remove_reader(worker.conn.fileno())
+            return
+        worker.last_seen = time.time()
+        if kind == "ready":
+            worker.port = data
+            while worker.pending:
+                self.send(worker, worker.pending.popleft())
+        elif kind == "stats":
+            worker.stats = data
+
+    def worker_exited(self, worker):
+        """ Restarts a worker that has exited """
+        self.loop.remove_reader(worker.process.sentinel)
+        self.loop.remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        worker.process.join()
+        worker.port = None
+        if self.stopping:
+            return
+        logging.error("worker %d (pid %d) exited with code %s, restarting",
+                      worker.index, worker.process.pid,
+                      worker.process.exitcode)
+        worker.restarts += 1
+        self.loop.call_later(RESTART_DELAY, self.start_worker, worker)
+
+    def dispatch(self, data):
+        """ Sends an event to the worker owning the call """
+        if not data or 'params' not in data or \
+                'key' not in data['params']:
+            return
+        key = data['params']['key']
+        worker = self.workers[zlib.crc32(key.encode()) % self.count]
+        if worker.port:
+            self.send(worker, data)
+            return
+        if len(worker.pending) >= MAX_PENDING_EVENTS:
+            self.dropped += 1
+            logging.warning("worker %d not available, dropping event for %s",
+                            worker.index, key)
+            return
+        worker.pending.append(data)
+
+    def send(self, worker, data):
+        """ Sends an event to a worker """
+        self.sock.sendto(json.dumps(data).encode(),
+                         ("127.0.0.1", worker.port))
+
+    def stats(self):
+        """ Returns the health of all the workers """
+        now = time.time()
+        return {
+            "dropped_events": self.dropped,
+            "calls": sum(w.stats.get("calls", 0) for w in self.workers),
+            "workers": {
+                w.index: {
+                    "pid": w.process.pid if w.process else None,
+                    "alive": bool(w.process and w.process.is_alive()),
+                    "restarts": w.restarts,
+                    "last_seen": round(now - w.last_seen, 1)
+                    if w.last_seen else None,
+                    "stats": w.stats,
+                } for w in self.workers
+            },
+        }
+
+    async def shutdown(self, s, event):
+        """ Stops the workers and the supervisor """
+        if self.stopping:
+            return
+        logging.info("Received exit signal %s...", s)
+        self.stopping = True
+        try:
+            event.unsubscribe()
+        except (OpenSIPSEventException, OpenSIPSMIException) as e:
+            logging.error("Error unsubscribing from event: %s", e)
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process:
+                await asyncio.to_thread(worker.process.join)
+        logging.info("Shutdown complete.")
+        self.done.set_result(None)
+
+    async def run(self):
+        """ Runs the supervisor """
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.log_listener = QueueListener(self.log_queue,
+                                          *logging.getLogger().handlers)
+        self.log_listener.start()
+        try:
+            await self.supervise()
+        finally:
+            self.log_listener.stop()
+
+    async def supervise(self):
+        """ Starts the workers and dispatches the events until shutdown """
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        host_ip = Config.engine("event_ip", "EVENT_IP", "127.0.0.1")
+        port = int(Config.engine("event_port", "EVENT_PORT", "0"))
+        handler = OpenSIPSEventHandler(engine.mi_conn, "datagram",
+                                       ip=host_ip, port=port)
+        try:
+            event = handler.async_subscribe("E_UA_SESSION", self.dispatch)
+        except OpenSIPSEventException as e:
+            logging.error("Error subscribing to event: %s", e)
+            return
+        _, port = event.socket.sock.getsockname()
+        logging.info("Starting supervisor with %d workers at %s:%hu",
+                     self.count, host_ip, port)
+
+        metrics.register("supervisor", self.stats)
+        stats_interval = int(Config.engine("stats_interval",
+                                           "STATS_INTERVAL", "60"))
+        if stats_interval > 0:
+            asyncio.create_task(metrics.report(stats_interval))
+
+        for s in [signal.SIGTERM, signal.SIGINT]:
+            self.loop.add_signal_handler(
+                s, lambda s=s: asyncio.create_task(self.shutdown(s, event)))
+
+        try:
+            await self.done
+        except asyncio.CancelledError:
+            pass
+
+
+def run(count):
+    """ Runs the supervisor and its count workers """
+    asyncio.run(Supervisor(count).run())
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Pre-established WebSocket sessions to the AI providers """
+
+import math
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from websockets.asyncio.client import connect
+from websockets.protocol import State
+
+import metrics
+from config import Config
+
+# how often idle sessions are checked and the pools refilled
+MAINTENANCE_INTERVAL = 1
+# the call arrival rate is measured over this many seconds
+RATE_WINDOW = 60
+
+_pools = {}
+
+
+class WebSocketPool():  # pylint: disable=too-many-instance-attributes
+    """ Keeps idle sessions to an endpoint, ready to be used by new calls
+
+    A session is opened and its greeting message received in advance, so a
+    new call does not wait for DNS, TCP, TLS and the server hello. The pool
+    is sized from the recent arrival rate of the calls and the time needed
+    to open a session, between min_size and max_size; with no recent calls,
+    only min_size sessions are kept. Idle sessions are closed after
+    max_idle seconds, or kept alive with a periodic keepalive message.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def __init__(self, name, url, headers, min_size=0, max_size=4,
+                 max_idle=60, keepalive=None, keepalive_interval=5):
+        self.name = name
+        self.url = url
+        self.headers = headers
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.keepalive = json.dumps(keepalive) if keepalive else None
+        self.keepalive_interval = keepalive_interval
+        self.idle = deque()
+        self.opening = 0
+        self.arrivals = deque()
+        self.task = None
+        self.setup = metrics.LatencyStats()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "failed": 0}
+
+    async def open(self):
+        """ Opens a session and returns it along with its greeting """
+        start = time.perf_counter()
+        ws = await connect(self.url, additional_headers=self.headers)
+        try:
+            greeting = await ws.recv()
+        except Exception:
+            await ws.close()
+            raise
+        self.setup.observe((time.perf_counter() - start) * 1000)
+        return ws, greeting
+
+    async def acquire(self):
+        """ Returns an open session and its greeting, from the pool if
+        possible """
+        now = time.monotonic()
+        self.arrivals.append(now)
+        if not self.task:
+            self.task = asyncio.create_task(self.maintain())
+        while self.idle:
+            ws, greeting, created, _ = self.idle.popleft()
+            if ws.state == State.OPEN and now - created < self.max_idle:
+                self.stats["hits"] += 1
+                self.refill()
+                return ws, greeting
+            self.discard(ws)
+        self.stats["misses"] += 1
+        self.refill()
+        return await self.open()
+
+    def target(self):
+        """ Returns how many idle sessions should be kept """
+        now = time.monotonic()
+        while self.arrivals and self.arrivals[0] < now - RATE_WINDOW:
+            self.arrivals.popleft()
+        if not self.arrivals:
+            return self.min_size
+        rate = len(self.arrivals) / RATE_WINDOW
+        setup = (self.setup.total / self.setup.count / 1000
+                 if self.setup.count else 1)
+        # the calls expected while a session is being opened, doubled
+        needed = math.ceil(2 * rate * setup) + 1
+        return max(self.min_size, min(self.max_size, needed))
+
+    def refill(self):
+        """ Opens sessions in the background, up to the target size """
+        for _ in range(self.target() - len(self.idle) - self.opening):
+            self.opening += 1
+            asyncio.create_task(self.add())
+
+    async def add(self):
+        """ Opens a new idle session """
+        try:
+            ws, greeting = await self.open()
+            now = time.monotonic()
+            self.idle.append((ws, greeting, now, now))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.stats["failed"] += 1
+            logging.warning("%s: cannot open pooled session: %s",
+                            self.name, e)
+        finally:
+            self.opening -= 1
+
+    def discard(self, ws):
+        """ Closes a session that can no longer be used """
+        self.stats["expired"] += 1
+        asyncio.create_task(ws.close())
+
+    async def ping(self, ws):
+        """ Sends the keepalive message on an idle session """
+        try:
+            await ws.send(self.keepalive)
+        except Exception:  # pylint: disable=broad-exception-caught
+            await ws.close()
+
+    async def maintain(self):
+        """ Expires and keeps alive the idle sessions, and refills the pool """
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            now = time.monotonic()
+            target = self.target()
+            kept = deque()
+            for ws, greeting, created, pinged in self.idle:
+                if ws.state != State.OPEN or now - created >= self.max_idle \
+                        or len(kept) >= target:
+                    self.discard(ws)
+                    continue
+                if self.keepalive and \
+                        now - pinged >= self.keepalive_interval:
+                    # a failed keepalive closes the session, which is then
+                    # dropped by the next check
+                    asyncio.create_task(self.ping(ws))
+                    pinged = now
+                kept.append((ws, greeting, created, pinged))
+            self.idle = kept
+            self.refill()
+
+    def get_stats(self):
+        """ Returns the pool statistics """
+        return {**self.stats, "idle": len(self.idle),
+                "opening": self.opening, "target": self.target(),
+                "setup_ms": self.setup.to_dict()}
+
+    async def close(self):
+        """ Closes the idle sessions """
+        if self.task:
+            self.task.cancel()
+        while self.idle:
+            await self.idle.popleft()[0].close()
+
+
+def get_pool(name, url, headers, keepalive=None):
+    """ Returns the pool of a provider's endpoint and credentials, or None
+    if pooling is disabled """
+    max_size = int(Config.engine("ws_pool_max", "WS_POOL_MAX", "4"))
+    if max_size <= 0:
+        return None
+    key = (name, url, tuple(sorted(headers.items())))
+    pool = _pools.get(key)
+    if not pool:
+        pool = WebSocketPool(
+            f"{name}-{len(_pools)}", url, headers,
+            min_size=int(Config.engine("ws_pool_min", "WS_POOL_MIN", "0")),
+            max_size=max_size,
+            max_idle=float(Config.engine("ws_pool_idle", "WS_POOL_IDLE",
+                                         "60")),
+            keepalive=keepalive)
+        _pools[key] = pool
+    return pool
+
+
+async def acquire(name, url, headers, keepalive=None):
+    """ Returns an open session to an endpoint, and its greeting """
+    pool = get_pool(name, url, headers, keepalive)
+    if pool:
+        return await pool.acquire()
+    ws = await connect(url, additional_headers=headers)
+    return ws, await ws.recv()
+
+
+async def close_pools():
+    """ Closes all the idle sessions """
+    for pool in _pools.values():
+        await pool.close()
+
+
+metrics.register("ws_pools",
+                 lambda: {p.name: p.get_stats() for p in _pools.values()})
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2024 SIP Point Consulting SRL
+#
+# This file is part of the OpenSIPS AI Voice Connector project
+# (see https://github.com/OpenSIPS/opensips-ai-voice-connector-ce).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+""" Tests the streaming Ogg Opus demuxer """
+
+import random
+import struct
+
+import pytest
+
+from opus import OggOpus, ogg_page_crc
+
+# lacing values of a page, at most
+MAX_SEGMENTS = 255
+
+
+def reference_crc(data, crc=0):
+    """ Bit by bit Ogg CRC32, as in the specification """
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ 0x04C11DB7) & 0xFFFFFFFF
+            else:
+                crc = (crc << 1) & 0xFFFFFFFF
+    return crc
+
+
+def build_page(segments, flags=0, sequence=0):
+    """ Builds an Ogg page holding segments, a list of (data, lacing) """
+    lacing = bytes(length for _, length in segments)
+    header = b'OggS' + struct.pack('<BBqIII', 0, flags, 0, 1, sequence, 0) + \
+        bytes([len(lacing)]) + lacing
+    page = bytearray(header + b''.join(data for data, _ in segments))
+    page[22:26] = reference_crc(page).to_bytes(4, 'little')
+    return bytes(page)
+
+
+def build_stream(packets):
+    """ Builds the Ogg pages of a stream carrying packets, after the Opus
+    headers; packets are split in segments of 255 bytes, spanning pages """
+    segments = []
+    for packet in packets:
+        for i in range(0, len(packet) + 1, 255):
+            data = packet[i:i + 255]
+            segments.append((data, len(data)))
+    pages = [build_page([(b'OpusHead' + bytes(11), 19)], 0x02, 0),
+             build_page([(b'OpusTags' + bytes(8), 16)], 0, 1)]
+    continued = False
+    for i in range(0, len(segments), MAX_SEGMENTS):
+        page_segments = segments[i:i + MAX_SEGMENTS]
+        pages.append(build_page(page_segments, 0x01 if continued else 0,
+                                len(pages)))
+        continued = page_segments[-1][1] == 255
+    return pages
+
+
+def random_packets(rng, count):
+    """ Returns packets of various sizes, including multiples of 255 """
+    sizes = [1, 254, 255, 256, 510, 1000, 3000]
+    return [rng.randbytes(rng.choice(sizes) if rng.random() < 0.5
+                          else rng.randint(1, 400))
+            for _ in range(count)]
+
+
+def feed_split(demuxer, data, rng):
+    """ Feeds data in chunks split at random boundaries """
+    packets = []
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([1, 2, 3, 27, rng.randint(1, 5000)])
+        packets += demuxer.feed(data[pos:pos + size])
+        pos += size
+    return packets
+
+
+@pytest.mark.parametrize("length", [0, 1, 22, 255, 4096])
+def test_crc(length):
+    """ The CRC of a page matches the specification """
+    page = bytearray(random.Random(length).randbytes(26 + length))
+    expected = reference_crc(page[:22] + bytes(4) + page[26:])
+    assert ogg_page_crc(page) == expected
+    assert ogg_page_crc(memoryview(page)) == expected
+
+
+def test_page_crc():
+    """ The checksum field of a page is not part of its CRC """
+    page = build_page([(b'x' * 100, 100)])
+    assert ogg_page_crc(page) == int.from_bytes(page[22:26], 'little')
+    assert ogg_page_crc(memoryview(page)) == ogg_page_crc(page)
+
+
+def test_whole_stream():
+    """ A stream fed at once returns its packets, without the headers """
+    packets = random_packets(random.Random(0), 50)
+    demuxer = OggOpus(b''.join(build_stream(packets)))
+    assert demuxer.packets() == packets
+    assert demuxer.crc_errors == 0
+    assert demuxer.discarded == 0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunks(seed):
+    """ Chunks split at any boundary return the same packets """
+    rng = random.Random(seed)
+    packets = random_packets(rng, 200)
+    demuxer = OggOpus()
+    assert feed_split(demuxer, b''.join(build_stream(packets)), rng) == \
+        packets
+    assert demuxer.crc_errors == 0
+
+
+def test_packet_spanning_pages():
+    """ A packet continued on the next page is reassembled """
+    packets = [b'a' * 255 * 300, b'b']
+    pages = build_stream(packets)
+    assert len(pages) == 4
+    assert OggOpus(b''.join(pages)).packets() == packets
+
+
+def test_packets_returned_as_completed():
+    """ A packet is returned as soon as its page is complete """
+    pages = build_stream([b'first', b'second'])
+    demuxer = OggOpus()
+    assert demuxer.feed(b''.join(pages[:2])) == []
+    assert demuxer.feed(pages[2][:-1]) == []
+    assert demuxer.feed(pages[2][-1:]) == [b'first', b'second']
+
+
+def test_invalid_crc():
+    """ A corrupted page is discarded, the next ones are still parsed """
+    pages = build_stream([b'lost'])
+    corrupted = bytearray(pages[2])
+    corrupted[-1] ^= 0xFF
+    good = build_page([(b'kept', 4)], 0, 3)
+    demuxer = OggOpus(b''.join(pages[:2]) + bytes(corrupted) + good)
+    assert demuxer.packets() == [b'kept']
+    assert demuxer.crc_errors == 1
+    assert OggOpus(bytes(corrupted), check_crc=False).packets() != []
+
+
+def test_resynchronize():
+    """ Garbage between pages is skipped """
+    pages = build_stream([b'one', b'two'])
+    data = pages[0] + pages[1] + b'Ogg garbage' + pages[2]
+    demuxer = OggOpus()
+    assert feed_split(demuxer, data, random.Random(1)) == [b'one', b'two']
+    assert demuxer.discarded == len(b'Ogg garbage')
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4